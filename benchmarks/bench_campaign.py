@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of a campaign update, stage by stage, against a
+local stub API (see pacetrack.stub_api).
+
+For each campaign size, a synthetic campaign (with the goals of
+campaigns/0001_wikicite_now_2018) is created in a temporary directory
+and run through:
+
+  from_api             PTCampaignState.from_api(), a full scan
+  save                 PTCampaignState.save()
+  from_json_path       loading the saved full state, article results included
+  get_all_results      PTCampaign._get_all_results()
+  render_report        PTCampaign.render_report()
+  render_article_list  PTCampaign.render_article_list()
+
+Each stage reports wall time, API requests (total and per article) and
+the process's peak RSS so far. Every size runs in its own process, so
+peak RSS isn't carried over between sizes, and the stub API runs in
+another, so serving requests doesn't count toward scan time.
+
+Run from the repo root:
+
+  python -m benchmarks.bench_campaign --sizes 100,1000,10000,50000 --output bench.json
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import datetime
+import resource
+import platform
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+
+from ruamel import yaml
+
+
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(CUR_PATH)
+GOALS_CONFIG_PATH = os.path.join(PROJECT_PATH, 'campaigns', '0001_wikicite_now_2018', 'config.yaml')
+DEFAULT_SIZES = '100,1000,10000,50000'
+DEFAULT_PORT = 8799
+STAGES = ('from_api', 'save', 'from_json_path', 'get_all_results', 'render_report', 'render_article_list')
+
+
+def _get_peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on Linux
+
+
+def create_campaign(campaign_dir, size):
+    "Write out a synthetic campaign config and article list of *size* articles."
+    with open(GOALS_CONFIG_PATH, 'rb') as f:
+        goals = yaml.safe_load(f)['goals']
+    config = {'id': 'bench_%s' % size,
+              'name': 'Benchmark %s' % size,
+              'lang': 'en',
+              'description': 'Synthetic benchmark campaign',
+              'contacts': [],
+              'wikiproject_name': 'WikiProject_Newspapers',
+              'campaign_start_date': datetime.date(2018, 6, 1),
+              'campaign_end_date': datetime.date(2018, 12, 15),
+              'date_created': datetime.date(2018, 11, 29),
+              'article_list': {'type': 'sparql_json_file',
+                               'path': 'articles.json',
+                               'title_key': 'title'},
+              'rate_limit': 0,  # the stub API is local
+              'rev_cache_max_mb': 0,  # measure the API, not the cache
+              'goals': goals}
+    os.makedirs(campaign_dir)
+    with open(os.path.join(campaign_dir, 'config.yaml'), 'wb') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    with open(os.path.join(campaign_dir, 'articles.json'), 'wb') as f:
+        json.dump([{'title': 'Benchmark article %06d' % i} for i in range(size)], f)
+    return config
+
+
+def run_size(size, api_url):
+    "Run all the stages for one campaign size, in this process."
+    from pacetrack import update, metrics
+    from pacetrack.session import get_conn_stats
+
+    metrics.set_api_url(api_url)
+    tmp_path = tempfile.mkdtemp(prefix='pt_bench_')
+    try:
+        campaign_dir = os.path.join(tmp_path, 'campaigns', 'bench_%s' % size)
+        create_campaign(campaign_dir, size)
+        update.STATIC_PATH = tmp_path + '/static/'
+        ptc = update.PTCampaign.from_path(campaign_dir, load_start_state=False)
+        ptc.load_article_list()
+
+        stages = {}
+        ctx = {}
+
+        def from_api():
+            ctx['state'] = update.PTCampaignState.from_api(ptc, datetime.datetime.utcnow())
+
+        def save():
+            ctx['state'].save()
+
+        def from_json_path():
+            full_path = ptc.get_latest_state_path(full=True)
+            state = update.PTCampaignState.from_json_path(ptc, full_path, full=True)
+            len(state.article_results)  # article results are loaded lazily
+            ptc.start_state = ptc.latest_state = state
+
+        def get_all_results():
+            ptc._get_all_results()
+
+        stage_funcs = {'from_api': from_api,
+                       'save': save,
+                       'from_json_path': from_json_path,
+                       'get_all_results': get_all_results,
+                       'render_report': ptc.render_report,
+                       'render_article_list': ptc.render_article_list}
+        for stage in STAGES:
+            start_requests = get_conn_stats()['requests']
+            start_time = time.time()
+            stage_funcs[stage]()
+            wall_time = time.time() - start_time
+            request_count = get_conn_stats()['requests'] - start_requests
+            stages[stage] = {'wall_time': round(wall_time, 4),
+                             'requests': request_count,
+                             'requests_per_article': round(request_count / float(size), 4),
+                             'peak_rss_kb': _get_peak_rss_kb()}
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return {'article_count': size, 'stages': stages}
+
+
+def _wait_for_port(port, timeout=30):
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('stub API did not start on port %s' % port)
+
+
+def main():
+    prs = ArgumentParser(description='time the stages of a campaign update against a local stub API')
+    prs.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated campaign sizes')
+    prs.add_argument('--latency', type=float, default=0.0, help='stub API latency, in seconds')
+    prs.add_argument('--port', type=int, default=DEFAULT_PORT)
+    prs.add_argument('--output', help='path to write JSON results to (default: stdout)')
+    prs.add_argument('--run-size', type=int, help=SUPPRESS)  # used to run each size in a child process
+    prs.add_argument('--api-url', help=SUPPRESS)
+    args = prs.parse_args()
+
+    if args.run_size:  # child process, see below
+        print(json.dumps(run_size(args.run_size, args.api_url)))
+        return
+
+    api_url = 'http://127.0.0.1:%s/' % args.port
+    stub_proc = subprocess.Popen([sys.executable, '-m', 'pacetrack', 'serve-stub-api',
+                                  '--port', str(args.port), '--latency', str(args.latency)],
+                                 cwd=PROJECT_PATH, stdout=open(os.devnull, 'wb'))
+    results = []
+    try:
+        _wait_for_port(args.port)
+        for size in [int(s) for s in args.sizes.split(',')]:
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_campaign',
+                                              '--run-size', str(size), '--api-url', api_url],
+                                             cwd=PROJECT_PATH)
+            result = json.loads(output.splitlines()[-1])
+            results.append(result)
+            print('%7s articles: %s' % (size, ', '.join(['%s %.2fs' % (stage, result['stages'][stage]['wall_time'])
+                                                         for stage in STAGES])),
+                  file=sys.stderr)
+    finally:
+        stub_proc.terminate()
+        stub_proc.wait()
+
+    from pacetrack._version import __version__
+    report = {'pacetrack_version': __version__,
+              'python_version': platform.python_version(),
+              'platform': platform.platform(),
+              'date': datetime.datetime.utcnow().isoformat(),
+              'stub_api_latency': args.latency,
+              'results': results}
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(report_json + '\n')
+    else:
+        print(report_json)
+    return
+
+
+if __name__ == '__main__':
+    main()
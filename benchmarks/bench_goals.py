@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of goal evaluation, comparing compiled goals
+(pacetrack.goals) with per-article dynamic dispatch, as pacetrack did
+before goals were compiled.
+
+Run from the repo root:
+
+  python -m benchmarks.bench_goals --articles 10000
+"""
+from __future__ import unicode_literals, print_function, division
+
+import os
+import time
+import random
+import datetime
+import operator
+from argparse import ArgumentParser
+
+from ruamel import yaml
+from boltons.strutils import slugify
+
+from pacetrack import metrics
+from pacetrack.goals import compile_goals, eval_article_goals
+from pacetrack.update import PTArticle
+
+
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(CUR_PATH), 'campaigns',
+                                   '0001_wikicite_now_2018', 'config.yaml')
+EXTRA_GOALS = [{'name': 'Has Newspaper Navbox',
+                'metric': 'template_count',
+                'metric_args': {'template_names': ['Newspaper navbox', 'Navbox'],
+                                'template_regex': r'navbox$'},
+                'target': {'value': 1, 'cmp': 'ge'}},
+               {'name': 'Many Templates',
+                'metric': 'template_count',
+                'target': {'value': 20, 'cmp': 'ge'}}]
+TEMPLATE_NAMES = (['Infobox Newspaper', 'Infobox newspaper', 'Cite web', 'Cite news', 'Reflist',
+                   'Newspaper navbox', 'Authority control', 'Citation needed', 'Coord', 'Commons category']
+                  + ['Template %s' % i for i in range(40)])
+WIKIPROJECT_NAMES = ['Newspapers', 'Journalism', 'United States', 'Biography', 'Companies', 'Media']
+
+
+def _legacy_eval_one_article_goal(pta, goal):
+    # the per-article evaluation from before goals were compiled
+    ret = {}
+    metric_func = getattr(metrics, goal['metric'], None)
+    if metric_func is None:
+        raise RuntimeError('unexpected metric name: %r' % goal['metric'])
+    metric_args = goal.get('metric_args', {})
+    metric_val = metric_func(pta, **metric_args)
+    target_val = goal['target']['value']
+    cmp_name = goal['target'].get('cmp', 'ge')
+    if cmp_name == 'bool':
+        return {'done': bool(metric_val)}
+    cmp_func = getattr(operator, cmp_name, None)
+    ret['cur'] = metric_val
+    ret['target'] = target_val
+    ret['cmp'] = cmp_name
+    done = cmp_func(metric_val, target_val)
+    ret['done'] = done
+    start_val = 0.0
+    ret['remaining'] = 0.0 if done else target_val - metric_val
+    ret['progress'] = (metric_val - start_val) / (target_val - start_val)
+    return ret
+
+
+def _legacy_eval_article_goals(pta, goals):
+    ret = {}
+    for goal in goals:
+        ret[slugify(goal['name'])] = _legacy_eval_one_article_goal(pta, goal)
+    return ret
+
+
+def build_articles(count, seed=0):
+    rand = random.Random(seed)
+    timestamp = datetime.datetime.utcnow()
+    ret = []
+    for i in range(count):
+        pta = PTArticle(lang='en', title='Article %s' % i, timestamp=timestamp)
+        pta.rev_id, pta.talk_rev_id = i + 1, i + 1
+        pta.templates = rand.sample(TEMPLATE_NAMES, rand.randint(0, 30))
+        pta.wikiprojects = rand.sample(WIKIPROJECT_NAMES, rand.randint(0, 3))
+        pta.wikidata_item = ['Q%s' % i] if rand.random() < 0.9 else []
+        ret.append(pta)
+    return ret
+
+
+def _time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    prs = ArgumentParser(description='compare compiled and dynamic goal evaluation')
+    prs.add_argument('--articles', type=int, default=10000)
+    prs.add_argument('--repeat', type=int, default=3)
+    prs.add_argument('--config', default=DEFAULT_CONFIG_PATH)
+    args = prs.parse_args()
+
+    with open(args.config, 'rb') as f:
+        goals = yaml.safe_load(f)['goals'] + EXTRA_GOALS
+    articles = build_articles(args.articles)
+
+    goal_evaluators = compile_goals(goals)
+    for pta in articles:
+        if _legacy_eval_article_goals(pta, goals) != eval_article_goals(pta, goal_evaluators):
+            raise RuntimeError('compiled goal results differ for %r' % pta.title)
+
+    legacy_time = _time(lambda: [_legacy_eval_article_goals(pta, goals) for pta in articles], args.repeat)
+    compile_time = _time(lambda: compile_goals(goals), args.repeat)
+    compiled_time = _time(lambda: [eval_article_goals(pta, goal_evaluators) for pta in articles], args.repeat)
+
+    print('%s articles x %s goals, best of %s' % (len(articles), len(goals), args.repeat))
+    print('  dynamic dispatch: %8.2f ms' % (legacy_time * 1000))
+    print('  compiled:         %8.2f ms (+ %.3f ms to compile)' % (compiled_time * 1000, compile_time * 1000))
+    print('  speedup:          %8.2fx' % (legacy_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Startup time benchmark, per CLI subcommand.
+
+Each case runs in a fresh process, several times, and reports the
+fastest and median wall time:
+
+  version, list-campaigns  the full command, via `python -m pacetrack`
+  <subcommand> --help      CLI startup, up to argument parsing, for
+                           the commands which do real work
+  import:<module>          importing the module
+  scan_setup               importing pacetrack.update, plus the gevent
+                           monkey-patching a scan does first
+  render_setup             importing pacetrack.update, plus loading
+                           the templates a render does first
+
+so the import cost each subcommand pays before doing any work is
+tracked as the code changes.
+
+Run from the repo root:
+
+  python -m benchmarks.bench_startup --repeat 10 --output startup.json
+"""
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+import subprocess
+from argparse import ArgumentParser
+
+
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(CUR_PATH)
+DEFAULT_REPEAT = 5
+
+CLI_CASES = [('version', ['version']),
+             ('list-campaigns', ['list-campaigns']),
+             ('update --help', ['update', '--help']),
+             ('update-all --help', ['update-all', '--help']),
+             ('render-all --help', ['render-all', '--help'])]
+CODE_CASES = [('import:pacetrack.cli', 'import pacetrack.cli'),
+              ('import:pacetrack.update', 'import pacetrack.update'),
+              ('scan_setup', 'from pacetrack import update; update.patch_gevent()'),
+              ('render_setup', 'from pacetrack import update; update.get_ashes_env()')]
+
+
+def time_command(argv, repeat):
+    durations = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in range(repeat):
+            start_time = time.time()
+            subprocess.check_call(argv, cwd=PROJECT_PATH, stdout=devnull, stderr=devnull)
+            durations.append(time.time() - start_time)
+    durations.sort()
+    return {'min': round(durations[0], 4),
+            'median': round(durations[len(durations) // 2], 4),
+            'repeat': repeat}
+
+
+def main():
+    prs = ArgumentParser(description='time the startup of pacetrack subcommands')
+    prs.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs per case')
+    prs.add_argument('--output', help='path to write JSON results to (default: stdout)')
+    args = prs.parse_args()
+
+    results = {}
+    for name, cli_args in CLI_CASES:
+        results[name] = time_command([sys.executable, '-m', 'pacetrack'] + cli_args, args.repeat)
+        print('%24s: %.3fs' % (name, results[name]['min']), file=sys.stderr)
+    for name, code in CODE_CASES:
+        results[name] = time_command([sys.executable, '-c', code], args.repeat)
+        print('%24s: %.3fs' % (name, results[name]['min']), file=sys.stderr)
+    baseline = time_command([sys.executable, '-c', 'pass'], args.repeat)
+
+    from pacetrack._version import __version__
+    report = {'pacetrack_version': __version__,
+              'python_version': platform.python_version(),
+              'platform': platform.platform(),
+              'date': datetime.datetime.utcnow().isoformat(),
+              'interpreter_startup': baseline,
+              'results': results}
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(report_json + '\n')
+    else:
+        print(report_json)
+    return
+
+
+if __name__ == '__main__':
+    main()
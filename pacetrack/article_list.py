@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Loading and storing campaign article lists.
+
+SPARQL JSON article lists can run to 100k+ rows, most of each row
+being fields other than the title. They're parsed one row at a time
+(see iter_json_array()), keeping only the titles, which are
+normalized and de-duplicated as they stream in.
+
+Saved states refer to the article list they were scanned from by
+content hash, and each distinct list is stored once, under
+campaign_dir/data/title_lists/<hash>.json, rather than copied into
+every summary state file.
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import codecs
+import hashlib
+
+from boltons.fileutils import atomic_save, mkdir_p
+
+
+TITLE_LISTS_DIRNAME = 'title_lists'
+READ_CHUNK_SIZE = 64 * 1024
+_JSON_WS = ' \t\r\n'
+
+
+def iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
+    """Yield the items of the JSON array in the binary file *f* one at
+    a time, without reading the whole file into memory."""
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = '', 0, False
+    expect = '['  # then 'item_or_end', and 'item' and ',]' in turn
+    while True:
+        while pos < len(buf) and buf[pos] in _JSON_WS:
+            pos += 1
+        if pos < len(buf):
+            char = buf[pos]
+            if expect == '[':
+                if char != '[':
+                    raise ValueError('expected a JSON array, not %r' % buf[pos:pos + 20])
+                expect = 'item_or_end'
+                pos += 1
+                continue
+            if expect == ',]':
+                if char == ']':
+                    return
+                if char != ',':
+                    raise ValueError('expected "," or "]" in JSON array, not %r' % buf[pos:pos + 20])
+                expect = 'item'
+                pos += 1
+                continue
+            if char == ']' and expect == 'item_or_end':
+                return
+            if char in ',]':
+                raise ValueError('expected a JSON value in JSON array, not %r' % buf[pos:pos + 20])
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # an item may be cut short by the end of the buffer
+                # (e.g., "2." of "2.5"), so only take it once it's
+                # followed by a delimiter, or there's no more to read
+                if eof or (end < len(buf) and buf[end] in _JSON_WS + ',]'):
+                    yield item
+                    expect = ',]'
+                    pos = end
+                    continue
+        elif eof:
+            raise ValueError('unexpected end of JSON array')
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + utf8_decoder.decode(chunk, final=eof)
+        pos = 0
+
+
+def normalize_title(title):
+    """Normalize a title the way MediaWiki does for most wikis:
+    underscores to spaces, runs of whitespace collapsed, and the
+    first letter capitalized."""
+    title = ' '.join(title.replace('_', ' ').split())
+    return title[:1].upper() + title[1:]
+
+
+def iter_unique_titles(titles):
+    "Normalize *titles*, skipping empty titles and repeats, preserving order."
+    seen = set()
+    for title in titles:
+        if not title:
+            continue
+        title = normalize_title(title)
+        if title and title not in seen:
+            seen.add(title)
+            yield title
+    return
+
+
+def load_sparql_json_titles(json_path, title_key):
+    "Load the titles of a SPARQL JSON result list, one row at a time."
+    with open(json_path, 'rb') as f:
+        return list(iter_unique_titles(row.get(title_key) for row in iter_json_array(f)))
+
+
+def get_title_list_hash(titles):
+    return hashlib.sha1('\n'.join(titles).encode('utf8')).hexdigest()
+
+
+def save_title_list(data_dir, titles, title_list_hash=None):
+    """Store *titles* under *data_dir*, if a list with the same content
+    isn't already there, returning its hash."""
+    title_list_hash = title_list_hash or get_title_list_hash(titles)
+    path = os.path.join(data_dir, TITLE_LISTS_DIRNAME, title_list_hash + '.json')
+    if not os.path.exists(path):
+        mkdir_p(os.path.dirname(path))
+        with atomic_save(path) as f:
+            json.dump(titles, f)
+    return title_list_hash
+
+
+def load_title_list(data_dir, title_list_hash):
+    with open(os.path.join(data_dir, TITLE_LISTS_DIRNAME, title_list_hash + '.json'), 'rb') as f:
+        return json.load(f)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Batching of per-article API lookups into multi-title queries.
+
+A campaign scan works on many PTArticles concurrently. Instead of
+each article sending its own request, a BatchLoader collects the
+lookups (titles, revision ids) that articles are waiting on, resolves
+up to MAX_BATCH_SIZE of them with a single request, and hands each
+result back to the waiting article's greenlet.
+"""
+from __future__ import unicode_literals
+
+import gevent
+from gevent.pool import Group
+from gevent.event import AsyncResult
+from boltons.iterutils import unique, bucketize
+
+import metrics
+from metrics import MAX_BATCH_SIZE, format_datetime
+from log import tlog
+
+
+DEFAULT_MAX_WAIT = 0.05  # seconds a lookup waits for its batch to fill up
+
+_MISSING = object()
+
+
+class BatchLoader(object):
+    """Collects keys from concurrent get() calls and resolves them in
+    batches with *batch_func*, which takes a list of keys and returns
+    a map of key to result.
+
+    Keys left out of batch_func's result are resolved one at a time
+    with *fallback_func*, in the greenlet that asked for them.
+    """
+    def __init__(self, name, batch_func, fallback_func=None,
+                 max_size=MAX_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+        self.name = name
+        self.batch_func = batch_func
+        self.fallback_func = fallback_func
+        self.max_size = max_size
+        self.max_wait = max_wait
+
+        self._pending = []
+        self._flush_timer = None
+        self._batches = Group()  # in-flight batch greenlets, see close()
+
+        self.key_count = 0
+        self.batch_count = 0
+        self.fallback_count = 0
+
+    def get(self, key):
+        result = AsyncResult()
+        self._pending.append((key, result))
+        self.key_count += 1
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = gevent.spawn_later(self.max_wait, self._on_flush_timer)
+
+        ret = result.get()
+        if ret is _MISSING:
+            if self.fallback_func is None:
+                raise KeyError(key)
+            self.fallback_count += 1
+            ret = self.fallback_func(key)
+        return ret
+
+    def _on_flush_timer(self):
+        self._flush_timer = None
+        self._flush()
+
+    def _flush(self):
+        batch, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+        if batch:
+            self._batches.spawn(self._run_batch, batch)
+        return
+
+    def _run_batch(self, batch):
+        self.batch_count += 1
+        keys = unique([key for key, _ in batch])  # dupe titles share a lookup
+        try:
+            results = self.batch_func(keys)
+        except Exception as e:
+            for _, result in batch:
+                result.set_exception(e)
+            return
+        for key, result in batch:
+            result.set(results.get(key, _MISSING))
+        return
+
+    def get_stats(self):
+        return {'keys': self.key_count,
+                'batches': self.batch_count,
+                'fallbacks': self.fallback_count}
+
+    def close(self):
+        """Stop any pending flush and in-flight batches. Batches run
+        outside of the scan's pool, so they'd otherwise outlive a scan
+        that was cut short."""
+        if self._flush_timer is not None:
+            self._flush_timer.kill()
+            self._flush_timer = None
+        self._batches.kill()
+        self._pending = []
+        return
+
+
+def _get_revids_at_timestamps(keys):
+    ret = {}
+    for timestamp, titles in bucketize(keys, key=lambda k: k[1]).items():
+        revid_map = metrics._get_revids_at_timestamp([t for t, _ in titles], timestamp)
+        ret.update([((t, timestamp), revid) for t, revid in revid_map.items()])
+    return ret
+
+
+def _get_revid_at_timestamp(key):
+    return metrics._get_revid_at_timestamp(*key)
+
+
+class PTBatchFetcher(object):
+    """Batched counterparts to the network-backed PTArticle metrics in
+    the metrics module (get_revid, get_templates, etc.), with the same
+    signatures. Create one per scan, so that lookups are batched across
+    all of the scan's articles.
+
+    A batch only fills up with the lookups of articles in flight, so
+    scans keep at least min_concurrency articles in flight.
+    """
+    min_concurrency = 0  # the campaign's concurrency setting is enough
+
+    def __init__(self, max_wait=DEFAULT_MAX_WAIT):
+        self.revid_loader = BatchLoader('revid',
+                                        _get_revids_at_timestamps,
+                                        _get_revid_at_timestamp,
+                                        max_wait=max_wait)
+        self.templates_loader = BatchLoader('templates',
+                                            metrics._get_templates_for_revids,
+                                            metrics._get_templates,
+                                            max_wait=max_wait)
+        self.assessments_loader = BatchLoader('assessments',
+                                              metrics._get_assessments_for_titles,
+                                              metrics._get_assessments,
+                                              max_wait=max_wait)
+        self.wikidata_item_loader = BatchLoader('wikidata_item',
+                                                metrics._get_wikidata_items_for_revids,
+                                                metrics._get_article_wikidata_item,
+                                                max_wait=max_wait)
+        self.loaders = [self.revid_loader, self.templates_loader,
+                        self.assessments_loader, self.wikidata_item_loader]
+
+    def get_revid(self, pta):
+        return self.revid_loader.get((pta.title, format_datetime(pta.timestamp)))
+
+    def get_talk_revid(self, pta):
+        return self.revid_loader.get((pta.talk_title, format_datetime(pta.timestamp)))
+
+    def get_templates(self, pta):
+        if not pta.rev_id:
+            return []
+        return self.templates_loader.get(pta.rev_id)
+
+    def get_talk_templates(self, pta):
+        if not pta.talk_rev_id:
+            return []
+        return self.templates_loader.get(pta.talk_rev_id)
+
+    def get_assessments(self, pta):
+        return self.assessments_loader.get(pta.title)
+
+    def get_wikidata_item(self, pta):
+        if not pta.rev_id:
+            return []
+        return self.wikidata_item_loader.get(pta.rev_id)
+
+    def log_stats(self):
+        for loader in self.loaders:
+            tlog.info('batch_stats', loader=loader.name, **loader.get_stats()).success(
+                '{loader}: {keys} lookups in {batches} batched requests, {fallbacks} fallbacks')
+        return
+
+    def close(self):
+        """Stop the loaders' in-flight batches. Call before closing the
+        rev cache, which the batches write to."""
+        for loader in self.loaders:
+            loader.close()
+        return
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache for API results which are determined by a revision
+id (templates, citations, etc.). Revisions never change, so entries
+never go stale, and are only evicted, least recently used first, to
+keep the cache under its size limit.
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+
+from boltons.fileutils import mkdir_p
+
+from log import tlog
+
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024  # bytes
+CACHE_FILENAME = 'rev_cache.sqlite3'
+COMMIT_INTERVAL = 64  # writes between commits
+EVICT_RATIO = 0.9  # evict down to this fraction of max_size
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rev_cache (
+  endpoint TEXT NOT NULL,
+  rev_id INTEGER NOT NULL,
+  value BLOB NOT NULL,
+  atime REAL NOT NULL,
+  PRIMARY KEY (endpoint, rev_id)
+);
+CREATE INDEX IF NOT EXISTS rev_cache_atime ON rev_cache (atime);
+"""
+
+
+class RevisionCache(object):
+    """SQLite-backed map of (endpoint, rev_id) to JSON-serializable
+    value, size-bounded with LRU eviction.
+
+    The cache file can be shared between campaigns (and processes),
+    as SQLite handles the locking.
+    """
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        mkdir_p(os.path.dirname(path))
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.executescript(_SCHEMA)
+        self._uncommitted = 0
+        self._size = self._get_size()
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evict_count = 0
+
+    def _get_size(self):
+        return self._conn.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM rev_cache').fetchone()[0]
+
+    def get_many(self, endpoint, rev_ids):
+        "Returns a map of rev_id to value for all rev_ids found in the cache."
+        rev_ids = [int(r) for r in rev_ids if r]
+        ret = {}
+        for i in range(0, len(rev_ids), 500):  # stay under SQLite's variable limit
+            chunk = rev_ids[i:i + 500]
+            rows = self._conn.execute('SELECT rev_id, value FROM rev_cache'
+                                      ' WHERE endpoint = ? AND rev_id IN (%s)' % ','.join('?' * len(chunk)),
+                                      [endpoint] + chunk)
+            ret.update([(rev_id, json.loads(zlib.decompress(value))) for rev_id, value in rows])
+        if ret:
+            now = time.time()
+            self._conn.executemany('UPDATE rev_cache SET atime = ? WHERE endpoint = ? AND rev_id = ?',
+                                   [(now, endpoint, rev_id) for rev_id in ret])
+            self._mark_written(len(ret))
+        self.hit_count += len(ret)
+        self.miss_count += len(rev_ids) - len(ret)
+        return ret
+
+    def set_many(self, endpoint, rev_id_value_map):
+        now = time.time()
+        rows = []
+        for rev_id, value in rev_id_value_map.items():
+            if not rev_id:
+                continue
+            rows.append((endpoint, int(rev_id), sqlite3.Binary(zlib.compress(json.dumps(value))), now))
+            self._size += len(rows[-1][2])
+        self._conn.executemany('INSERT OR REPLACE INTO rev_cache VALUES (?, ?, ?, ?)', rows)
+        self._mark_written(len(rows))
+        if self._size > self.max_size:
+            self.evict()
+        return
+
+    def _mark_written(self, count):
+        self._uncommitted += count
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def evict(self):
+        "Removes least recently used entries until the cache fits in EVICT_RATIO of max_size."
+        self._size = self._get_size()  # other processes may share this cache
+        target_size = self.max_size * EVICT_RATIO
+        while self._size > target_size:
+            rows = self._conn.execute('SELECT endpoint, rev_id, LENGTH(value) FROM rev_cache'
+                                      ' ORDER BY atime LIMIT 1000').fetchall()
+            if not rows:
+                break
+            to_evict = []
+            for endpoint, rev_id, size in rows:
+                if self._size <= target_size:
+                    break
+                to_evict.append((endpoint, rev_id))
+                self._size -= size
+            self._conn.executemany('DELETE FROM rev_cache WHERE endpoint = ? AND rev_id = ?', to_evict)
+            self.evict_count += len(to_evict)
+        self.commit()
+        return
+
+    def get_stats(self):
+        return {'hits': self.hit_count,
+                'misses': self.miss_count,
+                'evictions': self.evict_count,
+                'size': self._size,
+                'path': self.path}
+
+    def log_stats(self):
+        tlog.info('rev_cache_stats', **self.get_stats()).success(
+            '{hits} hits, {misses} misses, {evictions} evictions, {size} bytes in {path}')
+
+    def close(self):
+        self.commit()
+        self._conn.close()
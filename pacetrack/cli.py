@@ -6,19 +6,21 @@ import subprocess
 
 from boltons.fileutils import mkdir_p
 from face import Command, Flag, face_middleware, UsageError
-from glom import glom, T
 
 from .log import tlog, LOG_PATH, JSUB_LOG_PATH, enable_debug_log
-from .update import DEBUG, get_all_campaign_dirs, load_and_update_campaign, PTCampaign, render_home
 from ._version import __version__
 
+# pacetrack.update and pacetrack.metrics are imported in the commands
+# which use them, so that commands which don't (e.g., version,
+# list-campaigns) start quickly.
+
 
 def print_version():
     'Print the pacetrack version and exit'
     print('pacetrack version %s' % __version__)
 
 
-def _build_jsub_update(args_, force, campaign_id):
+def _build_jsub_update(args_, force, full_scan, campaign_id):
     name = 'pt_update_' + campaign_id
     jsub_campaign_logs_path = JSUB_LOG_PATH + ('%s/' % campaign_id)
 
@@ -34,14 +36,16 @@ def _build_jsub_update(args_, force, campaign_id):
 
     if force:
         ret.append('--force')
+    if full_scan:
+        ret.append('--full-scan')
 
     ret.append(campaign_id)
 
     return ret
 
 
-def _run_jsub_update(args_, force, campaign_id):
-    argv = _build_jsub_update(args_, force, campaign_id)
+def _run_jsub_update(args_, force, full_scan, campaign_id):
+    argv = _build_jsub_update(args_, force, full_scan, campaign_id)
 
     with tlog.critical('jsub', argv=argv):
         subprocess.check_call(argv)
@@ -49,10 +53,14 @@ def _run_jsub_update(args_, force, campaign_id):
     return
 
 
-def update_all(campaign_ids=None, jsub=False, force=False, args_=None):
+def update_all(campaign_ids=None, jsub=False, force=False, full_scan=False, shared_fetch=False, args_=None):
     "Update all campaigns configured"
+    from .utils import get_all_campaign_dirs
+    from .update import load_and_update_campaign, update_campaigns, PTCampaign
     if jsub and not args_:
         raise RuntimeError('jsub requires parsed arguments (args_)')
+    if jsub and shared_fetch:
+        raise UsageError('--shared-fetch updates campaigns in one process, and cannot be used with --jsub')
 
     campaign_ids = set(campaign_ids or [])
     if campaign_ids:
@@ -63,19 +71,34 @@ def update_all(campaign_ids=None, jsub=False, force=False, args_=None):
                              % (', '.join(sorted(unknown_campaigns)),
                                 ', '.join(sorted(known_campaigns))))
 
+    shared_ptcs = []
     for campaign_dir in get_all_campaign_dirs():
         cur_campaign_id = os.path.split(campaign_dir)[1]
         if campaign_ids and cur_campaign_id not in campaign_ids:
             continue
+        if shared_fetch:
+            with tlog.critical('load_campaign_dir', path=campaign_dir) as _act:
+                ptc = PTCampaign.from_path(campaign_dir)
+                _act['name'] = ptc.name
+                if ptc.disabled:
+                    _act.failure("campaign {name!r} disabled, skipping.")
+                    continue
+            shared_ptcs.append(ptc)
+            continue
         if jsub:
-            _run_jsub_update(args_, force, cur_campaign_id)
+            _run_jsub_update(args_, force, full_scan, cur_campaign_id)
             continue
 
-        cur_pt = load_and_update_campaign(campaign_dir, force=force)
+        cur_pt = load_and_update_campaign(campaign_dir, force=force, full_scan=full_scan)
+
+    if shared_ptcs:
+        update_campaigns(shared_ptcs, force=force, full_scan=full_scan)
     return
 
 
 def prune(posargs_, dry_run):
+    from .utils import get_all_campaign_dirs
+    from .update import PTCampaign
     campaign_ids = posargs_
     for campaign_dir in get_all_campaign_dirs():
         if not campaign_ids or os.path.split(campaign_dir)[1] in campaign_ids:
@@ -83,13 +106,37 @@ def prune(posargs_, dry_run):
             cur_ptc.prune_by_frequency(dry_run=dry_run)
 
 
-def update(campaign_ids, args_, jsub=False, force=False):
+def reindex(posargs_):
+    "Rebuild the state manifest of one or more campaigns (default all) from the data directory"
+    from .utils import get_all_campaign_dirs
+    from .update import PTCampaign
+    campaign_ids = posargs_
+    for campaign_dir in get_all_campaign_dirs():
+        if not campaign_ids or os.path.split(campaign_dir)[1] in campaign_ids:
+            cur_ptc = PTCampaign.from_path(campaign_dir, load_start_state=False)
+            cur_ptc.reindex_states()
+
+
+def rebuild_history(posargs_):
+    "Import saved states of one or more campaigns (default all) into the columnar history store"
+    from .utils import get_all_campaign_dirs
+    from .update import PTCampaign
+    campaign_ids = posargs_
+    for campaign_dir in get_all_campaign_dirs():
+        if not campaign_ids or os.path.split(campaign_dir)[1] in campaign_ids:
+            cur_ptc = PTCampaign.from_path(campaign_dir, load_start_state=False)
+            cur_ptc.rebuild_history()
+
+
+def update(campaign_ids, args_, jsub=False, force=False, full_scan=False, shared_fetch=False):
     "Update one or more campaigns by name"
-    return update_all(campaign_ids, force=force, jsub=jsub, args_=args_)
+    return update_all(campaign_ids, force=force, jsub=jsub, full_scan=full_scan,
+                      shared_fetch=shared_fetch, args_=args_)
 
 
 def list_campaigns():
     "List available campaigns"
+    from .utils import get_all_campaign_dirs
     print('\n'.join(get_all_campaign_dirs(abspath=False)))
 
 
@@ -98,17 +145,51 @@ def list_states(posargs_):  # TODO
     pass
 
 
-def render_all():
+def render_all(force=False, workers=1):
     "Render reports for all campaigns using the freshest data already fetched."
-    campaign_dirs = get_all_campaign_dirs()
-    all_ptcs = []
-    for cd in campaign_dirs:
-        with tlog.critical('load_campaign_dir', path=cd) as _act:
-            ptc = PTCampaign.from_path(cd)
-            _act['name'] = ptc.name
-        ptc.render()
-        all_ptcs.append(ptc)
-    render_home(all_ptcs)
+    from .utils import get_all_campaign_dirs
+    from .update import render_campaigns, render_home
+    campaign_summaries = render_campaigns(get_all_campaign_dirs(), force=force, workers=workers)
+    render_home(campaign_summaries, force=force)
+    return
+
+
+def serve_stub_api(port, latency, error_rate, maxlag_rate, throttle_rps, stub_corpus):
+    "Serve a local stand-in for the MediaWiki API, for offline runs (see --api-url)"
+    from . import stub_api
+
+    corpus = stub_api.RecordedCorpus.from_path(stub_corpus) if stub_corpus else stub_api.SyntheticCorpus()
+    app = stub_api.StubAPI(corpus, latency=latency, error_rate=error_rate,
+                           maxlag_rate=maxlag_rate, throttle_rps=throttle_rps)
+    server = stub_api.serve(app, port=port)
+    print('serving stub API at http://127.0.0.1:%s/ (use --api-url)' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+    return
+
+
+def build_stub_replica(posargs_, db_path, stub_corpus):
+    "Load the stub API's pages for one or more campaigns (default all) into a SQLite stand-in for the replica DB"
+    from . import stub_api
+    from .utils import get_all_campaign_dirs
+    from .update import PTCampaign
+
+    if os.path.exists(db_path):
+        raise UsageError('database already exists, remove it first: %r' % db_path)
+    if stub_corpus:
+        stub_api.build_replica_db(stub_api.RecordedCorpus.from_path(stub_corpus), db_path)
+    else:
+        campaign_ids = posargs_
+        titles = []
+        for campaign_dir in get_all_campaign_dirs():
+            if not campaign_ids or os.path.split(campaign_dir)[1] in campaign_ids:
+                cur_ptc = PTCampaign.from_path(campaign_dir, load_start_state=False)
+                cur_ptc.load_article_list()
+                titles.extend(cur_ptc.article_title_list)
+        stub_api.build_replica_db(stub_api.SyntheticCorpus(), db_path, titles)
+    print('loaded stub replica at %s (use backend sqlite_path)' % db_path)
     return
 
 
@@ -120,20 +201,42 @@ def main(argv=None):
     # update_subcmd.add('campaign_name')
     cmd.add(update_subcmd)
     cmd.add(update_all)
-    cmd.add(render_all)
+    render_subcmd = Command(render_all)
+    render_subcmd.add('--workers', parse_as=int, missing=1, doc='number of processes to load and render campaigns with')
+    cmd.add(render_subcmd)
     cmd.add(list_campaigns)
+    cmd.add(reindex, posargs={'display': 'campaign_id'})
+    cmd.add(rebuild_history, posargs={'display': 'campaign_id'})
     cmd.add(print_version, name='version')
+    stub_subcmd = Command(serve_stub_api)
+    stub_subcmd.add('--port', parse_as=int, missing=8765, doc='port to listen on')
+    stub_subcmd.add('--latency', parse_as=float, missing=0.0, doc='mean seconds to wait before each response')
+    stub_subcmd.add('--error-rate', parse_as=float, missing=0.0, doc='fraction of requests failed with a 503')
+    stub_subcmd.add('--maxlag-rate', parse_as=float, missing=0.0, doc='fraction of API requests given a maxlag error')
+    stub_subcmd.add('--throttle-rps', parse_as=int, missing=0, doc='requests per second served before responding with 429s')
+    stub_subcmd.add('--stub-corpus', missing=None, doc='path to a recorded corpus JSON file (default: synthetic pages)')
+    cmd.add(stub_subcmd)
+    stub_replica_subcmd = Command(build_stub_replica, posargs={'display': 'campaign_id'})
+    stub_replica_subcmd.add('--db-path', missing='stub_replica.db', doc='path of the SQLite database to create')
+    stub_replica_subcmd.add('--stub-corpus', missing=None, doc='path to a recorded corpus JSON file (default: synthetic pages)')
+    cmd.add(stub_replica_subcmd)
     # cmd.add(prune)  # mostly for testing
 
     cmd.add('--jsub', parse_as=True, doc='run commands through the WMF Labs job grid (for production use only)')
-    cmd.add('--force', parse_as=True, doc='ignore configured fetch frequency and force updates')
+    cmd.add('--force', parse_as=True, doc='ignore configured fetch frequency and force updates (and re-render unchanged pages)')
+    cmd.add('--full-scan', parse_as=True, doc='refetch all articles, not just those changed since the latest state')
+    cmd.add('--shared-fetch', parse_as=True, doc='update campaigns together, fetching articles tracked by several campaigns once')
     cmd.add('--dry-run', parse_as=True, doc='log actions without performing them (e.g., do not remove files)')
+    cmd.add('--api-url', missing=None,
+            doc='base URL of the wiki to query, e.g., a local serve-stub-api'
+            ' (default: $PACETRACK_API_URL or English Wikipedia)')
 
     # flags
-    cmd.add('--debug', doc='increase logging level', parse_as=True, missing=DEBUG)
+    cmd.add('--debug', doc='increase logging level', parse_as=True, missing=False)
 
     # middlewares
     cmd.add(mw_cli_log)
+    cmd.add(mw_api_url)
 
     try:
         cmd.run()
@@ -151,3 +254,11 @@ def mw_cli_log(next_, debug):
     tlog.critical('start').success('started {0}, logging to {1}', os.getpid(), LOG_PATH)
     with tlog.critical('cli', argv=sys.argv):
         return next_()
+
+
+@face_middleware
+def mw_api_url(next_, api_url):
+    if api_url:
+        from . import metrics
+        metrics.set_api_url(api_url)
+    return next_()
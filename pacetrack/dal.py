@@ -1,6 +1,285 @@
 # -*- coding: utf-8 -*-
+"""Data access for campaign scans, from the MediaWiki API (the
+default) or straight from a wiki replica database.
+
+Toolforge tools can query read-only replicas of each wiki's database,
+which answer "the latest revision before T of these pages" or "the
+templates transcluded on these pages" in a couple of set-based SQL
+queries, where the API takes a request per MAX_BATCH_SIZE titles, or
+per revision. A campaign picks its backend in its config.yaml:
+
+  backend:
+    type: replica
+
+ReplicaBatchFetcher has the same interface as batch.PTBatchFetcher,
+batching lookups the same way, up to REPLICA_BATCH_SIZE per query.
+To fill those batches, replica scans keep at least REPLICA_BATCH_SIZE
+articles in flight, whatever the campaign's concurrency, which still
+bounds the connections to the API.
+Lookups the replicas can't answer, like the templates of a revision
+that's no longer a page's latest, fall back to the API, as do
+citations, which come from the REST API either way.
+
+For local runs and testing, set sqlite_path to a SQLite stand-in
+with the tables in REPLICA_SCHEMA_PATH, e.g., one made by `pt
+build-stub-replica`. The schema also loads into MySQL, for a stand-in
+reached with host, port and database.
+"""
+from __future__ import unicode_literals
 
 import os
+import time
+import sqlite3
+
+from gevent.lock import Semaphore
+from boltons.iterutils import bucketize
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+import metrics
+from batch import BatchLoader, PTBatchFetcher, DEFAULT_MAX_WAIT
+from run_stats import get_active_run_stats
+from log import tlog
+
 
-# TODO: someday
 DB_CONFIG_PATH = os.path.expanduser('~/replica.my.cnf')  # Available by default on Labs
+REPLICA_HOST_TMPL = '%s.analytics.db.svc.wikimedia.cloud'  # analytics, as scans run long queries
+REPLICA_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replica_schema.sql')
+REPLICA_BATCH_SIZE = 500  # max titles/revids per query
+
+NS_MAIN, NS_TALK, NS_TEMPLATE = 0, 1, 10
+# namespaces of transcluded pages, with the prefixes the API gives
+# them after metrics strips "Template:"; others are left out
+TRANSCLUDED_NS_PREFIXES = {NS_TEMPLATE: '', 828: 'Module:'}
+
+
+def split_title(title):
+    "Split a page title into the page table's namespace and title."
+    if title.startswith('Talk:'):
+        return NS_TALK, title[len('Talk:'):].replace(' ', '_')
+    return NS_MAIN, title.replace(' ', '_')
+
+
+def to_mw_timestamp(timestamp):
+    "Convert an ISO8601 timestamp ('2018-11-29T20:09:07Z') to the database's '20181129200907'."
+    return ''.join([c for c in timestamp if c.isdigit()])
+
+
+def _to_text(val):
+    # the replicas' title columns are binary, so come back as bytes
+    if isinstance(val, bytes):
+        return val.decode('utf8')
+    return val
+
+
+def _placeholders(vals):
+    return ', '.join(['%s'] * len(vals))
+
+
+class ReplicaDB(object):
+    """A database connection, shared by the scan's greenlets, with
+    queries for each of the lookups in ReplicaBatchFetcher.
+
+    :param conn: a DB-API connection to a wiki replica, or a stand-in
+    :param paramstyle: the connection's parameter style, 'format' for
+    pymysql, or 'qmark' for sqlite3. Queries are written with %s.
+    """
+    def __init__(self, conn, paramstyle='format'):
+        self.conn = conn
+        self.paramstyle = paramstyle
+        self._lock = Semaphore()  # queries yield to other greenlets when sockets are patched
+        self.query_count = 0
+
+    def query(self, name, sql, params=()):
+        "Run a query, recorded under replica:*name* in the run stats."
+        if self.paramstyle == 'qmark':
+            sql = sql.replace('%s', '?')
+        start, error = time.time(), True
+        try:
+            with self._lock:
+                cursor = self.conn.cursor()
+                try:
+                    cursor.execute(sql, tuple(params))
+                    rows = cursor.fetchall()
+                finally:
+                    cursor.close()
+            error = False
+        finally:
+            self.query_count += 1
+            run_stats = get_active_run_stats()
+            if run_stats is not None:
+                run_stats.record_request('replica:' + name, time.time() - start, error=error)
+        return [tuple([_to_text(v) for v in row]) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+    def _get_page_map(self, titles):
+        # map of (namespace, db title) to the input title
+        return dict([(split_title(t), t) for t in titles])
+
+    def get_revids_at_timestamps(self, keys):
+        """Batched lookup of the latest revision of each page at a
+        timestamp, like batch._get_revids_at_timestamps().
+
+        :param keys: list of (title, ISO8601 timestamp) pairs
+        :return: a map from key to revision id, None for pages which
+        are missing, or were created after the timestamp
+        """
+        ret = dict([(key, None) for key in keys])
+        for timestamp, ts_keys in bucketize(keys, key=lambda k: k[1]).items():
+            page_map = self._get_page_map([t for t, _ in ts_keys])
+            for ns, ns_titles in bucketize(page_map.keys(), key=lambda p: p[0]).items():
+                db_titles = [t for _, t in ns_titles]
+                rows = self.query('revisions', 'SELECT page_title, rev_id FROM page'
+                                  ' JOIN revision ON rev_page = page_id'
+                                  ' WHERE page_namespace = %s AND page_title IN (' + _placeholders(db_titles) + ')'
+                                  ' AND rev_timestamp = (SELECT MAX(rev_timestamp) FROM revision'
+                                  '  WHERE rev_page = page_id AND rev_timestamp <= %s)',
+                                  [ns] + db_titles + [to_mw_timestamp(timestamp)])
+                for db_title, rev_id in rows:
+                    key = (page_map[ns, db_title], timestamp)
+                    if ret[key] is None or rev_id > ret[key]:  # same-second edits, take the later one
+                        ret[key] = rev_id
+        return ret
+
+    def get_templates_for_revids(self, rev_ids):
+        """Batched lookup of the pages transcluded by each revision.
+
+        Like the API's prop=templates, templatelinks only reflects the
+        latest revision of a page, so revisions which aren't are left
+        out of the result, for metrics._get_templates() to parse.
+        """
+        rows = self.query('latest_revisions', 'SELECT rev_id, rev_page FROM revision'
+                          ' JOIN page ON page_id = rev_page'
+                          ' WHERE rev_id IN (' + _placeholders(rev_ids) + ') AND rev_id = page_latest',
+                          rev_ids)
+        page_revid_map = dict([(page_id, rev_id) for rev_id, page_id in rows])
+        ret = dict([(rev_id, []) for rev_id in page_revid_map.values()])
+        if not page_revid_map:
+            return ret
+        page_ids = sorted(page_revid_map)
+        rows = self.query('templatelinks', 'SELECT tl_from, lt_namespace, lt_title FROM templatelinks'
+                          ' JOIN linktarget ON lt_id = tl_target_id'
+                          ' WHERE tl_from IN (' + _placeholders(page_ids) + ')'
+                          ' ORDER BY tl_from, lt_namespace, lt_title',
+                          page_ids)
+        for page_id, ns, title in rows:
+            if ns in TRANSCLUDED_NS_PREFIXES:
+                ret[page_revid_map[page_id]].append(TRANSCLUDED_NS_PREFIXES[ns] + title.replace('_', ' '))
+        return ret
+
+    def get_wikidata_items_for_revids(self, rev_ids):
+        """Batched lookup of the Wikidata items linked to (used with
+        the sitelink aspect by) each revision's page. Revisions not
+        on the replica yet are left out of the result."""
+        rows = self.query('wbc_entity_usage', 'SELECT rev_id, eu_entity_id FROM revision'
+                          ' LEFT JOIN wbc_entity_usage ON eu_page_id = rev_page AND eu_aspect = %s'
+                          ' WHERE rev_id IN (' + _placeholders(rev_ids) + ')'
+                          ' ORDER BY rev_id, eu_entity_id',
+                          ['S'] + list(rev_ids))
+        ret = {}
+        for rev_id, entity_id in rows:
+            ret.setdefault(rev_id, [])
+            if entity_id:
+                ret[rev_id].append(entity_id)
+        return ret
+
+    def get_assessments_for_titles(self, titles):
+        """Batched lookup of each page's WikiProject assessments, as a
+        map of project name to class and importance, like
+        metrics._get_assessments()."""
+        ret = dict([(title, {}) for title in titles])
+        page_map = self._get_page_map(titles)
+        for ns, ns_titles in bucketize(page_map.keys(), key=lambda p: p[0]).items():
+            db_titles = [t for _, t in ns_titles]
+            rows = self.query('page_assessments', 'SELECT page_title, pap_project_title, pa_class, pa_importance'
+                              ' FROM page JOIN page_assessments ON pa_page_id = page_id'
+                              ' JOIN page_assessments_projects ON pap_project_id = pa_project_id'
+                              ' WHERE page_namespace = %s AND page_title IN (' + _placeholders(db_titles) + ')',
+                              [ns] + db_titles)
+            for db_title, project, class_, importance in rows:
+                ret[page_map[ns, db_title]][project] = {'class': class_ or '', 'importance': importance or ''}
+        return ret
+
+
+def connect_replica(lang, backend_config):
+    """Connect to the replica database for the *lang* Wikipedia, or to
+    the stand-in configured in *backend_config*: a SQLite file at
+    sqlite_path, or a MySQL server at host and port, with database."""
+    if backend_config.get('sqlite_path'):
+        sqlite_path = os.path.expanduser(backend_config['sqlite_path'])
+        if not os.path.exists(sqlite_path):  # sqlite3 would create an empty database
+            raise IOError('no replica stand-in database at %r' % sqlite_path)
+        return ReplicaDB(sqlite3.connect(sqlite_path), paramstyle='qmark')
+    if pymysql is None:
+        raise ImportError('the replica backend requires pymysql (pip install pymysql),'
+                          ' or a sqlite_path for a local stand-in')
+    dbname = '%swiki' % lang
+    conn = pymysql.connect(host=backend_config.get('host') or REPLICA_HOST_TMPL % dbname,
+                           port=int(backend_config.get('port') or 3306),
+                           db=backend_config.get('database') or dbname + '_p',
+                           read_default_file=os.path.expanduser(backend_config.get('db_config_path')
+                                                                or DB_CONFIG_PATH),
+                           charset='utf8mb4')
+    return ReplicaDB(conn)
+
+
+class ReplicaBatchFetcher(PTBatchFetcher):
+    """A PTBatchFetcher whose lookups are answered by a ReplicaDB,
+    falling back to the API for the ones it leaves out. Revision-keyed
+    lookups go through the revision cache, as with the API."""
+    def __init__(self, db, max_wait=DEFAULT_MAX_WAIT, max_size=REPLICA_BATCH_SIZE):
+        self.db = db
+        self.min_concurrency = max_size
+
+        # plain functions, as the cache decorators copy the signature
+        @metrics.rev_cached_batch('templates')
+        def get_templates_for_revids(rev_ids):
+            return db.get_templates_for_revids(rev_ids)
+
+        @metrics.rev_cached_batch('wikidata_item')
+        def get_wikidata_items_for_revids(rev_ids):
+            return db.get_wikidata_items_for_revids(rev_ids)
+
+        self.revid_loader = BatchLoader('revid',
+                                        db.get_revids_at_timestamps,
+                                        lambda key: metrics._get_revid_at_timestamp(*key),
+                                        max_size=max_size, max_wait=max_wait)
+        self.templates_loader = BatchLoader('templates',
+                                            get_templates_for_revids,
+                                            metrics._get_templates,
+                                            max_size=max_size, max_wait=max_wait)
+        self.assessments_loader = BatchLoader('assessments',
+                                              db.get_assessments_for_titles,
+                                              metrics._get_assessments,
+                                              max_size=max_size, max_wait=max_wait)
+        self.wikidata_item_loader = BatchLoader('wikidata_item',
+                                                get_wikidata_items_for_revids,
+                                                metrics._get_article_wikidata_item,
+                                                max_size=max_size, max_wait=max_wait)
+        self.loaders = [self.revid_loader, self.templates_loader,
+                        self.assessments_loader, self.wikidata_item_loader]
+
+    def log_stats(self):
+        super(ReplicaBatchFetcher, self).log_stats()
+        tlog.info('replica_stats', query_count=self.db.query_count).success(
+            'answered lookups with {query_count} replica queries')
+        return
+
+    def close(self):
+        super(ReplicaBatchFetcher, self).close()
+        self.db.close()
+
+
+def get_fetcher(lang, backend_config=None):
+    """Create the batch fetcher for a scan of *lang* articles, per
+    *backend_config*, a campaign's backend setting (see
+    PTCampaign.backend)."""
+    if backend_config and backend_config.get('type') == 'replica':
+        return ReplicaBatchFetcher(connect_replica(lang, backend_config))
+    return PTBatchFetcher()
+
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Campaign goals, compiled for evaluation against many articles.
+
+Everything about a goal which doesn't depend on the article (its slug,
+metric function, comparison operator, etc.) is resolved once, when the
+campaign's goals are compiled, so evaluating a scan's articles is only
+metric calls and comparisons.
+"""
+from __future__ import unicode_literals, division
+
+import operator
+
+import attr
+from boltons.strutils import slugify
+
+import metrics
+
+
+CMP_NAMES = ('gt', 'ge', 'lt', 'le', 'eq', 'ne', 'bool')
+DEFAULT_CMP = 'ge'
+START_VALUE = 0.0  # TODO: per-article start values, from the start state
+UNKNOWN_RESULT = {'done': None, 'unknown': True}
+
+
+@attr.s(slots=True, frozen=True)
+class GoalEvaluator(object):
+    name = attr.ib()
+    slug = attr.ib()
+    metric_func = attr.ib(repr=False)
+    cmp_name = attr.ib()
+    cmp_func = attr.ib(repr=False)  # None for bool goals
+    target_value = attr.ib()
+    requires = attr.ib(repr=False)  # PTArticle attributes used by the metric
+
+    @classmethod
+    def from_goal(cls, goal):
+        cmp_name = goal['target'].get('cmp', DEFAULT_CMP)
+        if cmp_name not in CMP_NAMES:
+            raise RuntimeError('unexpected goal target cmp for goal %r: %r (expected one of %r)'
+                               % (goal['name'], cmp_name, CMP_NAMES))
+        return cls(name=goal['name'],
+                   slug=slugify(goal['name']),
+                   metric_func=metrics.compile_metric(goal['metric'], goal.get('metric_args')),
+                   cmp_name=cmp_name,
+                   cmp_func=None if cmp_name == 'bool' else getattr(operator, cmp_name),
+                   target_value=goal['target']['value'],
+                   requires=metrics.get_metric_requires(goal['metric']))
+
+    def evaluate(self, pta):
+        metric_val = self.metric_func(pta)
+        if self.cmp_func is None:
+            return {'done': bool(metric_val)}
+        target_val = self.target_value
+        done = self.cmp_func(metric_val, target_val)
+        return {'cur': metric_val,
+                'target': target_val,
+                'cmp': self.cmp_name,
+                'done': done,
+                'remaining': 0.0 if done else target_val - metric_val,
+                'progress': get_progress(metric_val, target_val)}
+
+
+def get_progress(metric_val, target_val):
+    "Fraction of the way from START_VALUE to the target."
+    return (metric_val - START_VALUE) / (target_val - START_VALUE)
+
+
+def compile_goals(goals):
+    "Compile a campaign's goal configs into a list of GoalEvaluators."
+    # maybe default name to metric name, need to precheck they don't collide
+    return [GoalEvaluator.from_goal(goal) for goal in goals]
+
+
+def get_fetch_plan(goal_evaluators):
+    """The set of PTArticle attributes a scan needs to fetch to
+    evaluate *goal_evaluators*, including the attributes they are
+    derived from. rev_id is always included, as articles without one
+    don't exist."""
+    needed = set(['rev_id'])
+    for ge in goal_evaluators:
+        needed.update(ge.requires)
+    return metrics.resolve_attr_dependencies(needed)
+
+
+def eval_article_goals(pta, goal_evaluators):
+    """Evaluate *goal_evaluators* against *pta*. Goals which need an
+    attribute the scan couldn't fetch (see PTArticle.missing) are
+    unknown, rather than not done."""
+    missing = set(pta.missing)
+    ret = {}
+    for ge in goal_evaluators:
+        if missing.intersection(ge.requires):
+            ret[ge.slug] = dict(UNKNOWN_RESULT)
+        else:
+            ret[ge.slug] = ge.evaluate(pta)
+    return ret
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""Compact columnar store for a campaign's per-article goal results.
+
+Full state files repeat every title and the verbose per-goal result
+dicts in every snapshot. The history store keeps the same information
+as flat, append-only binary columns under campaign_dir/data/history/:
+
+  titles.json                   title dictionary, stored once
+  snapshots.json                per-snapshot metadata and row ranges
+  title_idx.int32               index into titles.json
+  rev_id.int64                  -1 for missing articles
+  talk_rev_id.int64
+  goal__<slug>__value.float64   the goal metric value (NaN if none)
+  goal__<slug>__done.int8       1 done, 0 not done, -1 unknown
+
+Every column has one row per article per snapshot, and snapshot i
+covers rows [offset, offset + count) of each column. Columns are read
+back as numpy memmaps, spanning all snapshots.
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+
+import numpy as np
+from boltons.strutils import slugify
+from boltons.fileutils import atomic_save, mkdir_p
+from boltons.timeutils import isoparse
+
+from log import tlog
+from goals import DEFAULT_CMP, UNKNOWN_RESULT, get_progress
+from statefile import iter_state_article_results, load_state_file, write_state_file
+
+
+HISTORY_DIRNAME = 'history'
+MISSING_REV_ID = -1
+UNKNOWN_DONE = -1
+
+BASE_COLUMNS = {'title_idx': 'int32',
+                'rev_id': 'int64',
+                'talk_rev_id': 'int64'}
+GOAL_COLUMN_DTYPES = {'value': 'float64',
+                      'done': 'int8'}
+_GOAL_COLUMN_FILL = {'value': np.nan,
+                     'done': UNKNOWN_DONE}
+
+
+def _goal_column_name(slug, kind):
+    return 'goal__%s__%s' % (slug, kind)
+
+
+def _to_value(val):
+    if val is None or isinstance(val, (list, dict)):
+        return np.nan
+    return float(val)
+
+
+def _to_done(val):
+    if val is None:
+        return UNKNOWN_DONE
+    return int(bool(val))
+
+
+def _get_goal_spec(result):
+    if result.get('unknown'):
+        return None  # says nothing about the goal, see goals.UNKNOWN_RESULT
+    return {'target': result.get('target'), 'cmp': result.get('cmp', 'bool')}
+
+
+class HistoryStore(object):
+    def __init__(self, path, goals=None):
+        self.path = path
+        # goal slug to target and cmp, from the campaign's goal config
+        self.goal_specs = dict([(slugify(goal['name']),
+                                 {'target': goal['target']['value'],
+                                  'cmp': goal['target'].get('cmp', DEFAULT_CMP)})
+                                for goal in goals or []])
+        self.titles = []
+        self.snapshots = []
+        self._title_idx_map = {}
+        self._column_dtypes = dict(BASE_COLUMNS)
+        self.load()
+
+    @classmethod
+    def from_data_dir(cls, data_dir, goals=None):
+        return cls(os.path.join(data_dir, HISTORY_DIRNAME), goals=goals)
+
+    @property
+    def row_count(self):
+        return sum([s['count'] for s in self.snapshots])
+
+    def load(self):
+        titles_path = os.path.join(self.path, 'titles.json')
+        snapshots_path = os.path.join(self.path, 'snapshots.json')
+        if os.path.exists(titles_path):
+            with open(titles_path, 'rb') as f:
+                self.titles = json.load(f)
+        if os.path.exists(snapshots_path):
+            with open(snapshots_path, 'rb') as f:
+                self.snapshots = json.load(f)
+        self._title_idx_map = dict([(t, i) for i, t in enumerate(self.titles)])
+        for snapshot in self.snapshots:
+            for slug in snapshot['goals']:
+                for kind, dtype in GOAL_COLUMN_DTYPES.items():
+                    self._column_dtypes[_goal_column_name(slug, kind)] = dtype
+        return
+
+    def _column_path(self, name):
+        return os.path.join(self.path, '%s.%s' % (name, self._column_dtypes[name]))
+
+    def get_snapshot_index(self, timestamp):
+        for i, snapshot in enumerate(self.snapshots):
+            if isoparse(snapshot['timestamp']) == timestamp:
+                return i
+        return None
+
+    def append(self, header, article_results):
+        """Append a snapshot from full state data: *header* holds the
+        summary fields (timestamp, campaign_results, etc.), and
+        *article_results* is an iterable of article result dicts, in
+        the full state file layout. Snapshots already in the store
+        (by timestamp) are skipped."""
+        timestamp = isoparse(unicode(header['timestamp']))
+        if self.get_snapshot_index(timestamp) is not None:
+            return False
+        mkdir_p(self.path)
+        row_count = self.row_count
+        self._truncate_columns(row_count)  # drop rows from any interrupted append
+
+        rows = dict([(name, []) for name in BASE_COLUMNS])
+        goal_specs = {}
+        new_titles = []
+        for article_data in article_results:
+            title = article_data['title']
+            if title not in self._title_idx_map:
+                self._title_idx_map[title] = len(self.titles)
+                self.titles.append(title)
+                new_titles.append(title)
+            rows['title_idx'].append(self._title_idx_map[title])
+            rows['rev_id'].append(article_data.get('rev_id') or MISSING_REV_ID)
+            rows['talk_rev_id'].append(article_data.get('talk_rev_id') or MISSING_REV_ID)
+            for slug, result in (article_data.get('results') or {}).items():
+                if slug not in goal_specs:
+                    goal_specs[slug] = self.goal_specs.get(slug) or _get_goal_spec(result)
+                    for kind in GOAL_COLUMN_DTYPES:
+                        rows[_goal_column_name(slug, kind)] = [_GOAL_COLUMN_FILL[kind]] * (len(rows['rev_id']) - 1)
+                elif goal_specs[slug] is None:  # so far only unknown results
+                    goal_specs[slug] = _get_goal_spec(result)
+                rows[_goal_column_name(slug, 'value')].append(_to_value(result.get('cur')))
+                rows[_goal_column_name(slug, 'done')].append(_to_done(result.get('done')))
+            for slug in goal_specs:  # goals missing from this article's results
+                for kind in GOAL_COLUMN_DTYPES:
+                    col_rows = rows[_goal_column_name(slug, kind)]
+                    if len(col_rows) < len(rows['rev_id']):
+                        col_rows.append(_GOAL_COLUMN_FILL[kind])
+        count = len(rows['rev_id'])
+        for slug, spec in goal_specs.items():
+            if spec is None:  # every result unknown, the spec is never used
+                goal_specs[slug] = {'target': None, 'cmp': 'bool'}
+
+        for slug in goal_specs:
+            for kind, dtype in GOAL_COLUMN_DTYPES.items():
+                name = _goal_column_name(slug, kind)
+                if name not in self._column_dtypes:  # new goal, backfill earlier snapshots
+                    self._column_dtypes[name] = dtype
+                    self._append_column(name, np.full(row_count, _GOAL_COLUMN_FILL[kind], dtype=dtype))
+        for name, dtype in self._column_dtypes.items():
+            if name in rows:
+                values = np.array(rows[name], dtype=dtype)
+            else:  # a goal no longer in the campaign
+                kind = name.rsplit('__', 1)[1]
+                values = np.full(count, _GOAL_COLUMN_FILL[kind], dtype=dtype)
+            self._append_column(name, values)
+
+        if new_titles:
+            with atomic_save(os.path.join(self.path, 'titles.json')) as f:
+                json.dump(self.titles, f)
+        # the snapshot only counts once snapshots.json is written
+        self.snapshots.append({'timestamp': unicode(header['timestamp']),
+                               'save_date': header.get('save_date'),
+                               'offset': row_count,
+                               'count': count,
+                               'goals': goal_specs,
+                               'campaign_results': header.get('campaign_results'),
+                               'goal_results': header.get('goal_results')})
+        with atomic_save(os.path.join(self.path, 'snapshots.json')) as f:
+            json.dump(self.snapshots, f, indent=2, sort_keys=True, default=str)
+        return True
+
+    def _append_column(self, name, values):
+        with open(self._column_path(name), 'ab') as f:
+            f.write(values.tobytes())
+        return
+
+    def _truncate_columns(self, row_count):
+        for name, dtype in self._column_dtypes.items():
+            path = self._column_path(name)
+            if not os.path.exists(path):
+                continue
+            expected_size = row_count * np.dtype(dtype).itemsize
+            if os.path.getsize(path) > expected_size:
+                with open(path, 'r+b') as f:
+                    f.truncate(expected_size)
+        return
+
+    def read_column(self, name):
+        """Memory-map a column, covering all snapshots. Slice it with a
+        snapshot's offset and count to get the snapshot's rows."""
+        dtype = self._column_dtypes[name]
+        if not self.row_count:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._column_path(name), dtype=dtype, mode='r', shape=(self.row_count,))
+
+    def read_goal_column(self, slug, kind='done'):
+        return self.read_column(_goal_column_name(slug, kind))
+
+    def read_snapshot_column(self, name, snapshot_idx):
+        snapshot = self.snapshots[snapshot_idx]
+        start = snapshot['offset']
+        return self.read_column(name)[start:start + snapshot['count']]
+
+    def iter_article_results(self, snapshot_idx):
+        """Yield article result dicts for a snapshot, in the full state
+        file layout. Only the goal results are kept in the history
+        store, so fetched attributes (templates, etc.) are not
+        included."""
+        snapshot = self.snapshots[snapshot_idx]
+        cols = dict([(name, self.read_snapshot_column(name, snapshot_idx)) for name in BASE_COLUMNS])
+        goal_cols = {}
+        for slug in snapshot['goals']:
+            goal_cols[slug] = (self.read_snapshot_column(_goal_column_name(slug, 'value'), snapshot_idx),
+                               self.read_snapshot_column(_goal_column_name(slug, 'done'), snapshot_idx))
+        for i in range(snapshot['count']):
+            rev_id, talk_rev_id = int(cols['rev_id'][i]), int(cols['talk_rev_id'][i])
+            results = {}
+            for slug, spec in snapshot['goals'].items():
+                value, done = goal_cols[slug][0][i], int(goal_cols[slug][1][i])
+                if done == UNKNOWN_DONE:  # see goals.eval_article_goals()
+                    results[slug] = dict(UNKNOWN_RESULT)
+                    continue
+                results[slug] = _build_goal_result(spec, value, bool(done))
+            yield {'title': self.titles[cols['title_idx'][i]],
+                   'rev_id': rev_id if rev_id != MISSING_REV_ID else None,
+                   'talk_rev_id': talk_rev_id if talk_rev_id != MISSING_REV_ID else None,
+                   'results': results}
+        return
+
+    def export_state_file(self, snapshot_idx, json_path):
+        "Write a snapshot out as a full state file."
+        snapshot = self.snapshots[snapshot_idx]
+        header = dict([(k, snapshot[k]) for k in ('timestamp', 'save_date',
+                                                  'campaign_results', 'goal_results')])
+        write_state_file(json_path, header, self.iter_article_results(snapshot_idx),
+                         article_count=snapshot['count'])
+        return
+
+    def import_state_file(self, json_path):
+        "Append a snapshot from a full state file, streaming its articles."
+        header = load_state_file(json_path, full=False)
+        with tlog.info('import_history_state', path=json_path) as _act:
+            _act['imported'] = self.append(header, iter_state_article_results(json_path))
+        return _act['imported']
+
+
+def _build_goal_result(spec, value, done):
+    # mirrors the result dicts built by goals.GoalEvaluator.evaluate
+    if spec['cmp'] == 'bool':
+        return {'done': done}
+    cur = None if np.isnan(value) else value
+    if cur is not None and cur == int(cur):
+        cur = int(cur)
+    target = spec['target']
+    ret = {'cur': cur, 'target': target, 'cmp': spec['cmp'], 'done': done}
+    if cur is not None and target is not None:
+        ret['remaining'] = 0.0 if done else target - cur
+        ret['progress'] = get_progress(cur, target)
+    return ret
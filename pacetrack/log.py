@@ -26,10 +26,33 @@ def build_stream_sink(stream):
 
 
 
-default_file_sink = build_stream_sink(open(LOG_PATH, 'a'))
+class LazyFile(object):
+    "Append-mode file, opened on the first write, so importing doesn't touch the log file."
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def write(self, data):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+_log_file = LazyFile(LOG_PATH)
+default_file_sink = build_stream_sink(_log_file)
 tlog.add_sink(default_file_sink)
 
 
+def write_log_text(text):
+    "Write already-formatted log lines (e.g., buffered in a worker process) to the log file."
+    _log_file.write(text)
+    _log_file.flush()
+
+
 stderr_fmt = file_fmt
 stderr_emt = StreamEmitter('stderr')
 stderr_filter = SensibleFilter(success='critical',
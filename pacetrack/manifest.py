@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Append-only index of a campaign's saved states.
+
+The manifest lives at campaign_dir/data/manifest.jsonl, one JSON
+record per line. "add" records map a state timestamp to its summary
+and full state file paths, along with the saved summary numbers, and
+"remove" records mark a file as pruned. Lookups of the latest state,
+or the state at a given time, become reads of this one file instead
+of walks of the data directory.
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import bisect
+import datetime
+
+from boltons.fileutils import atomic_save, mkdir_p
+
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+TIMESTAMP_KEY_FORMAT = '%Y%m%d_%H%M%S'  # same resolution as state filenames
+
+
+def to_timestamp_key(timestamp):
+    return timestamp.strftime(TIMESTAMP_KEY_FORMAT)
+
+
+class StateManifest(object):
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, MANIFEST_FILENAME)
+        self._entries = None  # timestamp key -> entry, see load()
+        self._keys = None  # sorted timestamp keys
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        entries = {}
+        if self.exists:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a partial line from an interrupted write
+                    self._apply(entries, record)
+        self._entries = entries
+        self._keys = sorted(entries)
+        return
+
+    def _apply(self, entries, record):
+        key = record['timestamp']
+        if record['op'] == 'add':
+            entries[key] = dict([(k, v) for k, v in record.items() if k != 'op'])
+        elif record['op'] == 'remove' and key in entries:
+            entries[key][record['kind']] = None
+            if not entries[key]['path'] and not entries[key]['full_path']:
+                del entries[key]
+        return
+
+    def _append(self, record):
+        if self._entries is None:
+            self.load()
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        mkdir_p(os.path.dirname(self.path))
+        # a single O_APPEND write keeps each record whole, even with
+        # concurrent readers
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._apply(self._entries, record)
+        self._keys = sorted(self._entries)
+        return
+
+    def add(self, timestamp, path, full_path, campaign_results, goal_results):
+        self._append({'op': 'add',
+                      'timestamp': to_timestamp_key(timestamp),
+                      'path': path,
+                      'full_path': full_path,
+                      'campaign_results': campaign_results,
+                      'goal_results': goal_results})
+
+    def remove(self, timestamp, full):
+        self._append({'op': 'remove',
+                      'timestamp': to_timestamp_key(timestamp),
+                      'kind': 'full_path' if full else 'path'})
+
+    def rewrite(self, entries):
+        """Atomically replace the manifest with "add" records for
+        *entries*, dropping the history of removals."""
+        lines = [json.dumps(dict(entry, op='add'), sort_keys=True, default=str) + '\n'
+                 for entry in sorted(entries, key=lambda e: e['timestamp'])]
+        mkdir_p(os.path.dirname(self.path))
+        with atomic_save(self.path) as f:
+            f.write(''.join(lines))
+        self.load()
+        return
+
+    def get_entries(self, full=True):
+        "All entries with a saved summary (or full) state, oldest first."
+        if self._entries is None:
+            self.load()
+        kind = 'full_path' if full else 'path'
+        return [self._entries[k] for k in self._keys if self._entries[k][kind]]
+
+    def get_latest(self, full=True):
+        entries = self.get_entries(full=full)
+        return entries[-1] if entries else None
+
+    def get_at(self, timestamp, full=True):
+        """The state saved at *timestamp*. If timestamp is a date, the
+        first state saved on that day."""
+        entries = self.get_entries(full=full)
+        keys = [e['timestamp'] for e in entries]
+        if isinstance(timestamp, datetime.datetime):
+            key = to_timestamp_key(timestamp)
+            idx = bisect.bisect_left(keys, key)
+            if idx < len(keys) and keys[idx] == key:
+                return entries[idx]
+            return None
+        day_prefix = timestamp.strftime('%Y%m%d')
+        idx = bisect.bisect_left(keys, day_prefix)
+        if idx < len(keys) and keys[idx].startswith(day_prefix):
+            return entries[idx]
+        return None
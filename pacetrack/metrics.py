@@ -3,19 +3,45 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 
+import os
 import re
 import datetime
 
 from boltons.iterutils import unique
+from boltons.funcutils import wraps
 from hyperlink import parse as parse_url
-import requests
 
 
-MW_API_URL = parse_url('https://en.wikipedia.org/w/api.php')
-REST_API_BASE_URL = parse_url('https://en.wikipedia.org/api/rest_v1/')
-REF_API_BASE_URL = REST_API_BASE_URL.child('page', 'references')
+DEFAULT_API_URL = 'https://en.wikipedia.org/'
+MW_API_URL = None  # see set_api_url()
+REST_API_BASE_URL = None
+REF_API_BASE_URL = None
+
+MAX_BATCH_SIZE = 50  # max titles/revids per action=query request (non-bot limit)
+MAXLAG = 5  # seconds of replication lag before the API asks us to back off
+
+_REV_CACHE = None  # see set_rev_cache()
 
 from log import tlog
+from session import send_request, APIError
+
+
+def set_api_url(base_url):
+    """Send API requests to the wiki at *base_url*, e.g.,
+    https://en.wikipedia.org/ or a local stub_api server. The action
+    API and REST API are expected at /w/api.php and /api/rest_v1/.
+    Defaults to the PACETRACK_API_URL env var, then DEFAULT_API_URL."""
+    global MW_API_URL, REST_API_BASE_URL, REF_API_BASE_URL
+    base_url = parse_url(unicode(base_url))
+    if base_url.path and base_url.path[-1]:
+        base_url = base_url.child('')  # make sure the path ends with a slash
+    MW_API_URL = base_url.click('w/api.php')
+    REST_API_BASE_URL = base_url.click('api/rest_v1/')
+    REF_API_BASE_URL = REST_API_BASE_URL.child('page', 'references')
+    return
+
+
+set_api_url(os.getenv('PACETRACK_API_URL') or DEFAULT_API_URL)
 
 
 def format_datetime(dt):
@@ -26,6 +52,46 @@ def format_datetime(dt):
 
 ## PTArticle-based Metrics
 
+# PTArticle attributes fetched (or derived) during a scan, mapped to
+# the attributes they are derived from. rev_id and talk_rev_id are
+# looked up first, see PTCampaignState.from_api().
+ATTR_DEPENDENCIES = {'rev_id': (),
+                     'talk_rev_id': (),
+                     'templates': ('rev_id',),
+                     'talk_templates': ('talk_rev_id',),
+                     'wikiprojects': ('talk_templates',),
+                     'assessments': ('talk_rev_id',),  # assessed on the talk page
+                     'citations': ('rev_id',),
+                     'wikidata_item': ('rev_id',)}
+
+
+def requires(*attr_names):
+    "Declares the PTArticle attributes a metric depends on."
+    def decorator(func):
+        func.requires = attr_names
+        return func
+    return decorator
+
+
+def get_metric_requires(metric_name):
+    """The attributes needed by the *metric_name* metric. Metrics which
+    don't declare them are assumed to need everything."""
+    metric_func = globals().get(metric_name)
+    return getattr(metric_func, 'requires', tuple(sorted(ATTR_DEPENDENCIES)))
+
+
+def resolve_attr_dependencies(attr_names):
+    "The set of *attr_names* and all the attributes they are derived from."
+    ret = set()
+    to_visit = list(attr_names)
+    while to_visit:
+        attr_name = to_visit.pop()
+        if attr_name in ret:
+            continue
+        ret.add(attr_name)
+        to_visit.extend(ATTR_DEPENDENCIES[attr_name])
+    return ret
+
 
 def get_revid(pta):
     return _get_revid_at_timestamp(pta.title, format_datetime(pta.timestamp))
@@ -60,18 +126,21 @@ def get_wikidata_item(pta):
     return _get_article_wikidata_item(pta.rev_id)
 
 
+@requires('rev_id')
 def article_exists(pta):
     if not pta.rev_id:
         return False
     return True
 
 
+@requires('citations')
 def ref_count(pta):
     if not pta.citations:
         return 0
     return len(pta.citations['references_by_id'].keys())
 
 
+@requires('citations')
 def ref_wikidata_count(pta):
     if not pta.citations:
         return 0
@@ -80,10 +149,12 @@ def ref_wikidata_count(pta):
                 in c[1]['content']['html']])
 
 
+@requires('wikidata_item')
 def wikidata_item(pta):
     return len(pta.wikidata_item)
 
 
+@requires('assessments')
 def assessment_avg(pta, scale=None, wikiproject=None):
     # TODO
     """assessments = pta.assessments.items()
@@ -95,6 +166,7 @@ def assessment_avg(pta, scale=None, wikiproject=None):
     pass
 
 
+@requires('wikiprojects')
 def in_wikiproject(pta, wikiproject=None, case_sensitive=False):
     wikiprojects = pta.wikiprojects
     if not case_sensitive:
@@ -103,6 +175,7 @@ def in_wikiproject(pta, wikiproject=None, case_sensitive=False):
     return wikiproject in wikiprojects
 
 
+@requires('templates')
 def template_count(pta, template_name=None, template_names=None, template_regex=None, case_sensitive=False):
     article_tmpl_names = pta.templates
     if template_name:
@@ -122,22 +195,145 @@ def template_count(pta, template_name=None, template_names=None, template_regex=
 
     return len(set(template_names) & set(article_tmpl_names))
 
+
+## Metric compilers
+#
+# Compiled counterparts of the metrics above, which do the work that
+# only depends on the metric_args (lowercasing, regex compilation,
+# etc.) once per goal instead of once per article. Each takes the
+# metric_args and returns a function of the PTArticle, with the same
+# result as the plain metric. See compile_metric().
+
+
+def compile_in_wikiproject(wikiproject=None, case_sensitive=False):
+    if case_sensitive:
+        return lambda pta: wikiproject in pta.wikiprojects
+    wikiproject = wikiproject.lower()
+    return lambda pta: any([w.lower() == wikiproject for w in pta.wikiprojects])
+
+
+def compile_template_count(template_name=None, template_names=None, template_regex=None, case_sensitive=False):
+    if template_name:
+        if template_names:
+            raise RuntimeError('template_count metric expected one of'
+                               ' "template_name" or "template_names" arg, not both')
+        template_names = [template_name]
+    if not template_names:
+        return lambda pta: len(pta.templates)
+
+    if template_regex:
+        template_pattern = re.compile(template_regex)
+        if case_sensitive:
+            return lambda pta: len([t for t in pta.templates if template_pattern.search(t)])
+        return lambda pta: len([t for t in unique([t.lower() for t in pta.templates])
+                                if template_pattern.search(t)])
+
+    if case_sensitive:
+        name_set = frozenset(template_names)
+        return lambda pta: len(name_set.intersection(pta.templates))
+    name_set = frozenset([tn.lower() for tn in template_names])
+    return lambda pta: len(name_set.intersection([t.lower() for t in pta.templates]))
+
+
+METRIC_COMPILERS = {'in_wikiproject': compile_in_wikiproject,
+                    'template_count': compile_template_count}
+
+
+def compile_metric(metric_name, metric_args=None):
+    """Returns a function of a PTArticle computing the *metric_name*
+    metric with *metric_args*, using the metric's compiler if it has
+    one."""
+    metric_args = metric_args or {}
+    if metric_name in METRIC_COMPILERS:
+        return METRIC_COMPILERS[metric_name](**metric_args)
+    metric_func = globals().get(metric_name)
+    if metric_name.startswith('_') or not callable(metric_func):
+        raise RuntimeError('unexpected metric name: %r' % metric_name)
+    if not metric_args:
+        return metric_func
+    return lambda pta: metric_func(pta, **metric_args)
+
 ##
 
+def set_rev_cache(rev_cache):
+    """Set the cache.RevisionCache used by the revision-keyed API
+    helpers below, or None to disable caching."""
+    global _REV_CACHE
+    _REV_CACHE = rev_cache
+
+
+def rev_cached(endpoint, rev_id_pos=0):
+    """Decorator for API helpers whose result is determined by the
+    revision id passed as the positional argument at *rev_id_pos*."""
+    def decorator(func):
+        @wraps(func)
+        def cached_func(*a):
+            rev_id = a[rev_id_pos]
+            if _REV_CACHE is None or not rev_id:
+                return func(*a)
+            cached = _REV_CACHE.get_many(endpoint, [rev_id])
+            if rev_id in cached:
+                return cached[rev_id]
+            ret = func(*a)
+            _REV_CACHE.set_many(endpoint, {rev_id: ret})
+            return ret
+        return cached_func
+    return decorator
+
+
+def rev_cached_batch(endpoint):
+    """Decorator for batched API helpers which take a list of revision
+    ids and return a map of revision id to result. Only the revision
+    ids missing from the cache are passed through."""
+    def decorator(func):
+        @wraps(func)
+        def cached_func(rev_ids):
+            if _REV_CACHE is None:
+                return func(rev_ids)
+            ret = _REV_CACHE.get_many(endpoint, rev_ids)
+            missing = [r for r in rev_ids if r not in ret]
+            if missing:
+                fetched = func(missing)
+                _REV_CACHE.set_many(endpoint, fetched)
+                ret.update(fetched)
+            return ret
+        return cached_func
+    return decorator
+
+
 @tlog.wrap('info', inject_as='act')
-def get_json(url, params=None, act=None):  # TODO: option for validating status code
+def get_json(url, params=None, act=None):
+    """GET *url* with *params*, returning the decoded JSON. Raises an
+    APIError for non-2xx responses, so that error bodies are never
+    mistaken for (and cached as) results."""
     params = dict(params or {})
     for k, v in params.items():
         url = url.set(unicode(k), unicode(v))
     if act:
         act['url'] = unicode(url)
-    resp = requests.get(url, params=params)
+    resp = send_request(url, endpoint=_get_endpoint_name(url, params))  # params are already set on url
+    if not 200 <= resp.status_code < 300:
+        raise APIError('got HTTP %s from %s' % (resp.status_code, url))
     return resp.json()
 
 
+def _get_endpoint_name(url, params):
+    # e.g., "query:revisions|templates", "parse", "rest:page/references"
+    if params.get('action'):
+        if params.get('prop'):
+            return '%s:%s' % (params['action'], params['prop'])
+        return params['action']
+    rest_path = url.path[len(REST_API_BASE_URL.path) - 1:]  # REST_API_BASE_URL ends with ''
+    return 'rest:' + '/'.join(rest_path[:2])
+
+
 def get_wapi_json(params):
+    "Send an action API request, raising an APIError for error responses."
     url = MW_API_URL
-    return get_json(url, params)
+    resp = get_json(url, dict(params, maxlag=MAXLAG))
+    if 'error' in resp:
+        raise APIError('API error %s: %s' % (resp['error'].get('code'), resp['error'].get('info')))
+    return resp
 
 
 def _get_revid_at_timestamp(title, timestamp):
@@ -165,6 +361,79 @@ def _get_revid_at_timestamp(title, timestamp):
     return ret
 
 
+def _merge_page(target, page):
+    # continued query responses split list-valued props (templates,
+    # etc.) across responses, so merge rather than overwrite
+    for key, val in page.items():
+        if isinstance(val, list) and isinstance(target.get(key), list):
+            target[key].extend([v for v in val if v not in target[key]])
+        elif isinstance(val, dict) and isinstance(target.get(key), dict):
+            target[key].update(val)
+        else:
+            target[key] = val
+    return target
+
+
+def get_wapi_query_pages(params):
+    """Run an action=query request for multiple titles or revids,
+    following continuation until the result is complete.
+
+    :param params: query params (prop, titles/revids, etc.), action
+    and format are set automatically
+    :return: a tuple of (pages, normalized), pages being a map of page
+    title to page data, and normalized being a map of input title to
+    the normalized page title
+
+    """
+    params = dict(params, action='query', format='json', formatversion=2)
+    pages, normalized = {}, {}
+    cont = {}
+    while True:
+        resp = get_wapi_json(dict(params, **cont))
+        query = resp.get('query', {})
+        for norm in query.get('normalized', []):
+            normalized[norm['from']] = norm['to']
+        for page in query.get('pages', []):
+            _merge_page(pages.setdefault(page['title'], {}), page)
+        if 'continue' not in resp:
+            break
+        cont = resp['continue']
+    return pages, normalized
+
+
+def _iter_revid_pages(pages):
+    for page in pages.values():
+        for rev in page.get('revisions', []):
+            yield rev['revid'], page
+
+
+def _get_revids_at_timestamp(titles, timestamp):
+    """Batched version of _get_revid_at_timestamp.
+
+    rvstart only works with a single title, so this fetches the latest
+    revision of every title. If the latest revision predates
+    timestamp, it is the revision at timestamp. Titles edited since
+    timestamp are left out of the result, for the caller to look up
+    one at a time.
+
+    :return: a map from title to revision id (None for missing pages)
+    """
+    pages, normalized = get_wapi_query_pages({'prop': 'revisions',
+                                              'rvprop': 'ids|timestamp',
+                                              'titles': '|'.join(titles)})
+    ret = {}
+    for title in titles:
+        page = pages.get(normalized.get(title, title))
+        if page is None or page.get('missing') or page.get('invalid'):
+            ret[title] = None
+            continue
+        latest_rev = page['revisions'][0]
+        if latest_rev['timestamp'] <= timestamp:  # both ISO8601 strings
+            ret[title] = latest_rev['revid']
+    return ret
+
+
+@rev_cached('templates')
 def _get_templates(oldid):
     """Get a list of templates as well as number of calls per template for a given revision (oldid)
 
@@ -188,20 +457,53 @@ def _get_templates(oldid):
     return ret
 
 
+@rev_cached_batch('templates')
+def _get_templates_for_revids(oldids):
+    """Batched version of _get_templates.
+
+    prop=templates only reflects the current revision of a page, so
+    only oldids which are still the latest revision of their page are
+    included in the result. The rest are left for _get_templates.
+    """
+    pages, _ = get_wapi_query_pages({'prop': 'info|revisions|templates',
+                                     'rvprop': 'ids',
+                                     'tllimit': 'max',
+                                     'revids': '|'.join([unicode(o) for o in oldids])})
+    ret = {}
+    for revid, page in _iter_revid_pages(pages):
+        if revid != page.get('lastrevid'):
+            continue
+        ret[revid] = [t['title'].replace('Template:', '') for t in page.get('templates', [])]
+    return ret
+
+
+@rev_cached('wikidata_item')
 def _get_article_wikidata_item(oldid):
     params = {'action': 'query',
               'prop': 'wbentityusage',
               'revids': oldid,
               'format': 'json'}
     resp = get_wapi_json(params)
-    try:
-        wbentities = resp['query']['pages'].values()[0]['wbentityusage']
-    except KeyError as e:
-        return []
-
+    # a page without wbentityusage has no items, but a response without
+    # pages is malformed, and raises rather than being cached as empty
+    wbentities = resp['query']['pages'].values()[0].get('wbentityusage', {})
     return [q for (q, val) in wbentities.items() if 'S' in val['aspects']]
 
 
+@rev_cached_batch('wikidata_item')
+def _get_wikidata_items_for_revids(oldids):
+    """Batched version of _get_article_wikidata_item"""
+    pages, _ = get_wapi_query_pages({'prop': 'revisions|wbentityusage',
+                                     'rvprop': 'ids',
+                                     'wbeulimit': 'max',
+                                     'revids': '|'.join([unicode(o) for o in oldids])})
+    ret = {}
+    for revid, page in _iter_revid_pages(pages):
+        wbentities = page.get('wbentityusage', {})
+        ret[revid] = [q for (q, val) in wbentities.items() if 'S' in val['aspects']]
+    return ret
+
+
 def _get_assessments(title):
     # can't actually get assessments from past versions of an article
     # see: https://phabricator.wikimedia.org/T211485
@@ -211,10 +513,19 @@ def _get_assessments(title):
               'formatversion': 2,
               'format': 'json'}
     resp = get_wapi_json(params)
-    try:
-        return resp['query']['pages'][0]['pageassessments']
-    except KeyError:
-        return {}
+    return resp['query']['pages'][0].get('pageassessments', {})
+
+
+def _get_assessments_for_titles(titles):
+    """Batched version of _get_assessments"""
+    pages, normalized = get_wapi_query_pages({'prop': 'pageassessments',
+                                              'palimit': 'max',
+                                              'titles': '|'.join(titles)})
+    ret = {}
+    for title in titles:
+        page = pages.get(normalized.get(title, title), {})
+        ret[title] = page.get('pageassessments', {})
+    return ret
 
 
 def check_infobox(template_calls):
@@ -244,6 +555,7 @@ def get_wikiproject(wikiproject, talk_revid):
     return False
 
 
+@rev_cached('citations', rev_id_pos=1)
 def _get_citations(title, old_id):
     # This API was depricated: 
     # https://phabricator.wikimedia.org/T247991
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Pace and completion date projection for campaign goals.
+
+Works on the goal time series from PTCampaign.load_all_states(). Rates
+are in goal ratio per day (e.g., 0.01 is one percent of the campaign's
+articles per day), computed over trailing windows of the series.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+import numpy as np
+
+
+DAY_SECONDS = 24 * 60 * 60
+PACE_WINDOWS = (('day', 1), ('week', 7), ('month', 30))  # name, days
+ACTUAL_PACE_WINDOW = 'week'
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_seconds(dt):
+    if not isinstance(dt, datetime.datetime):  # a date
+        dt = datetime.datetime(dt.year, dt.month, dt.day)
+    return (dt - _EPOCH).total_seconds()
+
+
+def _to_float(val):
+    return None if np.isnan(val) else float(val)
+
+
+def get_window_rates(timestamps, ratios, window_days):
+    """The rate of change at every point of the series, over the window
+    of *window_days* days ending at that point. A point's window starts
+    at the earliest state in range, so rates near the start of the
+    series cover less time. NaN where the window holds only one point.
+
+    :param timestamps: sorted array of epoch seconds
+    :param ratios: array of goal ratios, one per timestamp
+    """
+    starts = np.searchsorted(timestamps, timestamps - window_days * DAY_SECONDS, side='left')
+    elapsed = (timestamps - timestamps[starts]) / DAY_SECONDS
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = (ratios - ratios[starts]) / elapsed
+    rates[elapsed <= 0] = np.nan
+    return rates
+
+
+def get_goal_pace(points, target_ratio, end_date):
+    """Compute the pace of one goal from its series.
+
+    :param points: list of (timestamp, done_count, ratio), oldest first
+    :param target_ratio: the goal's target ratio
+    :param end_date: the campaign end date
+
+    The projection runs from the latest point, not the current time,
+    so the result only changes when a new state is saved.
+    """
+    timestamps = np.array([_to_seconds(p[0]) for p in points], dtype='float64')
+    ratios = np.array([p[2] for p in points], dtype='float64')
+    last_dt = points[-1][0]
+    cur_ratio = float(ratios[-1])
+    remaining = max(target_ratio - cur_ratio, 0.0)
+    days_left = (_to_seconds(end_date) - timestamps[-1]) / DAY_SECONDS + 1  # end date is inclusive
+
+    rates = dict([(name, _to_float(get_window_rates(timestamps, ratios, days)[-1]))
+                  for name, days in PACE_WINDOWS])
+    actual_pace = rates[ACTUAL_PACE_WINDOW]
+    if actual_pace is None and len(points) > 1:  # fall back to the whole series
+        elapsed = (timestamps[-1] - timestamps[0]) / DAY_SECONDS
+        actual_pace = float(ratios[-1] - ratios[0]) / elapsed if elapsed > 0 else None
+
+    required_pace = None
+    if remaining and days_left > 0:
+        required_pace = remaining / days_left
+
+    projected_date = None
+    if not remaining:
+        projected_date = last_dt
+    elif actual_pace and actual_pace > 0:
+        projected_date = last_dt + datetime.timedelta(days=remaining / actual_pace)
+
+    on_track = False
+    if projected_date is not None:
+        on_track = _to_seconds(projected_date) < _to_seconds(end_date) + DAY_SECONDS
+
+    return {'ratio': cur_ratio,
+            'target_ratio': target_ratio,
+            'remaining_ratio': remaining,
+            'days_left': max(days_left, 0.0),
+            'rates': rates,
+            'actual_pace': actual_pace,
+            'required_pace': required_pace,
+            'projected_date': projected_date.isoformat() if projected_date else None,
+            'on_track': on_track,
+            'point_count': len(points),
+            'last_timestamp': last_dt.isoformat()}
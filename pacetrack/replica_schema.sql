@@ -0,0 +1,56 @@
+-- The parts of the MediaWiki tables the replica backend queries (see
+-- dal.py), for a local stand-in for the wiki replicas. Loads into
+-- SQLite or MySQL, e.g., `mysql enwiki_p < replica_schema.sql`.
+-- Titles are stored as in MediaWiki, without the namespace prefix
+-- and with underscores for spaces, and timestamps as YYYYMMDDHHMMSS.
+
+CREATE TABLE page (
+  page_id INTEGER NOT NULL PRIMARY KEY,
+  page_namespace INTEGER NOT NULL,
+  page_title VARCHAR(255) NOT NULL,
+  page_latest INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX page_name_title ON page (page_namespace, page_title);
+
+CREATE TABLE revision (
+  rev_id INTEGER NOT NULL PRIMARY KEY,
+  rev_page INTEGER NOT NULL,
+  rev_timestamp CHAR(14) NOT NULL
+);
+CREATE INDEX rev_page_timestamp ON revision (rev_page, rev_timestamp);
+
+CREATE TABLE linktarget (
+  lt_id INTEGER NOT NULL PRIMARY KEY,
+  lt_namespace INTEGER NOT NULL,
+  lt_title VARCHAR(255) NOT NULL
+);
+CREATE UNIQUE INDEX lt_namespace_title ON linktarget (lt_namespace, lt_title);
+
+CREATE TABLE templatelinks (
+  tl_from INTEGER NOT NULL,
+  tl_target_id INTEGER NOT NULL,
+  tl_from_namespace INTEGER NOT NULL,
+  PRIMARY KEY (tl_from, tl_target_id)
+);
+
+CREATE TABLE wbc_entity_usage (
+  eu_row_id INTEGER NOT NULL PRIMARY KEY,
+  eu_entity_id VARCHAR(255) NOT NULL,
+  eu_aspect VARCHAR(37) NOT NULL,
+  eu_page_id INTEGER NOT NULL
+);
+CREATE INDEX eu_page_id ON wbc_entity_usage (eu_page_id, eu_entity_id);
+
+CREATE TABLE page_assessments_projects (
+  pap_project_id INTEGER NOT NULL PRIMARY KEY,
+  pap_project_title VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE page_assessments (
+  pa_page_id INTEGER NOT NULL,
+  pa_project_id INTEGER NOT NULL,
+  pa_class VARCHAR(20),
+  pa_importance VARCHAR(20),
+  pa_page_revision INTEGER NOT NULL,
+  PRIMARY KEY (pa_page_id, pa_project_id)
+);
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Per-run request and metric timing statistics.
+
+While a RunStats is collecting (see RunStats.collecting()), every API
+request made through session.send_request() is recorded under its
+endpoint (e.g., "query:revisions", "parse", "rest:page/references"),
+and every article lookup of a scan (get_revid, get_templates, etc.)
+under its function name. Lookup times include the wait for a batched
+request, so they reflect how long articles spent waiting on each.
+"""
+from __future__ import unicode_literals
+
+import time
+import datetime
+from contextlib import contextmanager
+
+
+PERCENTILES = (50, 95, 99)
+
+_ACTIVE = None
+
+
+def get_active_run_stats():
+    return _ACTIVE
+
+
+def _summarize(records):
+    import numpy as np  # slow to import, and only needed once a run is done
+
+    durations = np.array(records['durations'], dtype='float64')
+    ret = {'count': len(durations),
+           'errors': records['errors'],
+           'total_time': round(float(durations.sum()), 4)}
+    if 'bytes' in records:
+        ret['bytes'] = records['bytes']
+    if len(durations):
+        for pct, val in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+            ret['p%s' % pct] = round(float(val), 4)
+        ret['max'] = round(float(durations.max()), 4)
+    return ret
+
+
+class RunStats(object):
+    def __init__(self):
+        self.endpoints = {}
+        self.metrics = {}
+        self.start_time = None
+        self.duration = None
+
+    @contextmanager
+    def collecting(self):
+        "Record requests and lookups made in this block."
+        global _ACTIVE
+        prev_active, _ACTIVE = _ACTIVE, self
+        self.start_time = datetime.datetime.utcnow()
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.duration = time.time() - start
+            _ACTIVE = prev_active
+
+    def record_request(self, endpoint, duration, byte_count=0, error=False):
+        records = self.endpoints.setdefault(endpoint, {'durations': [], 'errors': 0, 'bytes': 0})
+        records['durations'].append(duration)
+        records['bytes'] += byte_count
+        if error:
+            records['errors'] += 1
+
+    def record_metric(self, name, duration, error=False):
+        records = self.metrics.setdefault(name, {'durations': [], 'errors': 0})
+        records['durations'].append(duration)
+        if error:
+            records['errors'] += 1
+
+    def wrap_metric(self, name, func):
+        "Wrap the article lookup *func* to record its calls under *name*."
+        def timed_func(pta):
+            start = time.time()
+            try:
+                ret = func(pta)
+            except Exception:
+                self.record_metric(name, time.time() - start, error=True)
+                raise
+            self.record_metric(name, time.time() - start)
+            return ret
+        return timed_func
+
+    def to_dict(self):
+        return {'start_time': self.start_time.isoformat() if self.start_time else None,
+                'duration': round(self.duration, 4) if self.duration is not None else None,
+                'endpoints': dict([(k, _summarize(v)) for k, v in self.endpoints.items()]),
+                'metrics': dict([(k, _summarize(v)) for k, v in self.metrics.items()])}
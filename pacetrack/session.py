@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Shared, keep-alive HTTP session for API calls.
+
+All API requests go through one module-level requests.Session, so
+concurrent scans reuse pooled connections instead of opening a new
+TCP+TLS connection per request.
+
+Requests are sent with send_request(), which paces them with a token
+bucket per host, and retries throttled (HTTP 429, MediaWiki maxlag
+and ratelimited) and failed requests with exponential backoff,
+honoring Retry-After.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import random
+from email.utils import parsedate_tz, mktime_tz
+
+from urlparse import urlparse
+
+from _version import __version__
+from run_stats import get_active_run_stats
+
+
+# requests is imported on first use (see _build_session()), as it's
+# slow to import, and most commands send no requests
+USER_AGENT_TMPL = ('pacetrack/%s (https://github.com/hatnote/pacetrack; mahmoud@hatnote.com)'
+                   ' python-requests/%s')
+DEFAULT_POOL_SIZE = 50  # connections per host, see configure_session()
+DEFAULT_KEEPALIVE_REQUESTS = 5000  # requests per session before it is recycled
+MAX_POOL_HOSTS = 10
+DEFAULT_RATE_LIMIT = 50  # requests per second per host, 0 for no limit
+DEFAULT_TIMEOUT = 60  # seconds to connect, and between bytes of the response
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds, doubled with each retry
+BACKOFF_MAX = 60
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# MediaWiki API error codes (sent with HTTP 200, in the
+# MediaWiki-API-Error header) which are worth retrying
+RETRY_API_ERRORS = frozenset(['maxlag', 'ratelimited', 'readonly'])
+THROTTLE_API_ERRORS = frozenset(['maxlag', 'ratelimited'])
+
+_SESSION_CONFIG = {'pool_size': DEFAULT_POOL_SIZE,
+                   'keepalive_requests': DEFAULT_KEEPALIVE_REQUESTS,
+                   'user_agent': os.getenv('PACETRACK_USER_AGENT')}  # None for the default, see _build_session()
+_REQUEST_CONFIG = {'rate_limit': DEFAULT_RATE_LIMIT,
+                   'timeout': DEFAULT_TIMEOUT,
+                   'max_retries': DEFAULT_MAX_RETRIES}
+
+_SESSION = None
+_SESSION_REQUEST_COUNT = 0
+_CLOSED_STATS = {'requests': 0, 'new_connections': 0}
+_HOST_BUCKETS = {}
+_REQUEST_STATS = {'retries': 0,
+                  'throttled': 0,
+                  'failures': 0,
+                  'rate_limit_wait': 0.0,
+                  'backoff_wait': 0.0}
+
+
+class APIError(Exception):
+    pass
+
+
+def configure_session(pool_size=None, keepalive_requests=None, user_agent=None,
+                      rate_limit=None, timeout=None, max_retries=None):
+    """Set the session parameters. The current session, if any, is
+    closed when they change, and the next request starts a new one.
+
+    :param pool_size: max connections kept open per host, should
+    match the scan concurrency
+    :param keepalive_requests: number of requests sent through a session
+    before it is closed and replaced, bounding connection lifetime
+    :param user_agent: User-Agent header, defaults to the
+    PACETRACK_USER_AGENT env var, then USER_AGENT_TMPL
+    :param rate_limit: max sustained requests per second, per host
+    :param timeout: seconds to wait for a connection or response data
+    :param max_retries: retries of a failed or throttled request
+    before it raises an APIError
+    """
+    new_config = dict(_SESSION_CONFIG)
+    if pool_size is not None:
+        new_config['pool_size'] = int(pool_size)
+    if keepalive_requests is not None:
+        new_config['keepalive_requests'] = int(keepalive_requests)
+    if user_agent is not None:
+        new_config['user_agent'] = user_agent
+
+    if new_config != _SESSION_CONFIG:
+        _SESSION_CONFIG.update(new_config)
+        close_session()
+
+    if rate_limit is not None and float(rate_limit) != _REQUEST_CONFIG['rate_limit']:
+        _REQUEST_CONFIG['rate_limit'] = float(rate_limit)
+        _HOST_BUCKETS.clear()
+    if timeout is not None:
+        _REQUEST_CONFIG['timeout'] = float(timeout)
+    if max_retries is not None:
+        _REQUEST_CONFIG['max_retries'] = int(max_retries)
+    return
+
+
+def _build_session():
+    import requests
+    import urllib3
+    from requests.adapters import HTTPAdapter
+
+    urllib3.disable_warnings()  # for labs
+    session = requests.Session()
+    # pool_block makes greenlets wait for a pooled connection when
+    # more requests are in flight than pool_size, instead of opening
+    # (and then discarding) extra connections
+    adapter = HTTPAdapter(pool_connections=MAX_POOL_HOSTS,
+                          pool_maxsize=_SESSION_CONFIG['pool_size'],
+                          pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    user_agent = _SESSION_CONFIG['user_agent'] or USER_AGENT_TMPL % (__version__, requests.__version__)
+    session.headers.update({'User-Agent': user_agent,
+                            'Accept-Encoding': 'gzip, deflate',  # decoded by requests
+                            'Connection': 'keep-alive'})
+    return session
+
+
+def get_session():
+    global _SESSION, _SESSION_REQUEST_COUNT
+    if _SESSION is not None and _SESSION_REQUEST_COUNT >= _SESSION_CONFIG['keepalive_requests']:
+        close_session()
+    if _SESSION is None:
+        _SESSION = _build_session()
+    _SESSION_REQUEST_COUNT += 1
+    return _SESSION
+
+
+class TokenBucket(object):
+    """Paces requests to *rate* per second on average, allowing bursts
+    of up to *capacity* requests.
+
+    Each request takes a token, even when the bucket is empty, so
+    concurrent callers queue up behind each other instead of all
+    retrying at once when tokens refill.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity if capacity is not None else max(self.rate, 1.0)
+        self._tokens = self.capacity
+        self._last_time = time.time()
+        self._paused_until = 0
+
+    def acquire(self):
+        "Take a token, returning the seconds to wait before sending."
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_time) * self.rate)
+        self._last_time = now
+        self._tokens -= 1
+        return max(-self._tokens / self.rate, self._paused_until - now, 0)
+
+    def pause(self, seconds):
+        "Hold all requests for *seconds*, e.g., when the host asks for a Retry-After."
+        self._paused_until = max(self._paused_until, time.time() + seconds)
+
+
+def _get_host_bucket(url):
+    if not _REQUEST_CONFIG['rate_limit']:
+        return None
+    host = urlparse(unicode(url)).netloc
+    if host not in _HOST_BUCKETS:
+        _HOST_BUCKETS[host] = TokenBucket(_REQUEST_CONFIG['rate_limit'])
+    return _HOST_BUCKETS[host]
+
+
+def _parse_retry_after(value):
+    "Retry-After is either seconds or an HTTP date, returns seconds."
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - time.time(), 0)
+
+
+def get_backoff(attempt, retry_after=None):
+    """Seconds to wait before retry number *attempt* (starting at 0):
+    the server's Retry-After, if any, or else exponential backoff with
+    full jitter."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def send_request(url, endpoint=None):
+    """GET *url* through the shared session, paced by the per-host
+    rate limit. Connection errors, timeouts, 429/5xx responses and
+    transient MediaWiki API errors (see RETRY_API_ERRORS) are retried
+    with backoff, up to the configured max_retries, after which an
+    APIError is raised. Other MediaWiki API errors raise an APIError
+    right away.
+
+    Other responses, including 4xx errors, are returned as-is.
+
+    Each attempt is recorded under *endpoint* (default: the URL's
+    path) in the active RunStats, if any.
+    """
+    from requests import ConnectionError, Timeout
+
+    bucket = _get_host_bucket(url)
+    run_stats = get_active_run_stats()
+    if endpoint is None:
+        endpoint = urlparse(unicode(url)).path
+    max_retries = _REQUEST_CONFIG['max_retries']
+    for attempt in range(max_retries + 1):
+        if bucket is not None:
+            wait = bucket.acquire()
+            if wait:
+                _REQUEST_STATS['rate_limit_wait'] += wait
+                time.sleep(wait)
+        retry_after = None
+        start_time = time.time()
+        try:
+            resp = get_session().get(url, timeout=_REQUEST_CONFIG['timeout'])
+        except (ConnectionError, Timeout) as e:
+            error = repr(e)
+            if run_stats is not None:
+                run_stats.record_request(endpoint, time.time() - start_time, error=True)
+        else:
+            api_error = resp.headers.get('MediaWiki-API-Error')
+            is_error = resp.status_code >= 400 or bool(api_error)
+            if run_stats is not None:
+                run_stats.record_request(endpoint, time.time() - start_time, len(resp.content), error=is_error)
+            if api_error and api_error not in RETRY_API_ERRORS:
+                _REQUEST_STATS['failures'] += 1
+                raise APIError('API error %s: %s' % (api_error, url))
+            if resp.status_code not in RETRY_STATUSES and not api_error:
+                return resp
+            error = api_error or 'HTTP %s' % resp.status_code
+            retry_after = _parse_retry_after(resp.headers.get('Retry-After'))
+            if api_error in THROTTLE_API_ERRORS or resp.status_code == 429:
+                _REQUEST_STATS['throttled'] += 1
+        if attempt == max_retries:
+            break
+        delay = get_backoff(attempt, retry_after)
+        if retry_after is not None and bucket is not None:
+            bucket.pause(delay)  # the whole host is throttled, not only this request
+        _REQUEST_STATS['retries'] += 1
+        _REQUEST_STATS['backoff_wait'] += delay
+        time.sleep(delay)
+    _REQUEST_STATS['failures'] += 1
+    raise APIError('request failed after %s attempts (%s): %s' % (max_retries + 1, error, url))
+
+
+def get_request_stats():
+    """Counts of retries, throttled responses and failed requests, and
+    seconds spent waiting on the rate limit and on backoff, by this
+    process."""
+    return dict(_REQUEST_STATS)
+
+
+def close_session():
+    global _SESSION, _SESSION_REQUEST_COUNT
+    if _SESSION is None:
+        return
+    for key, val in _get_pool_stats(_SESSION).items():
+        _CLOSED_STATS[key] += val
+    _SESSION.close()
+    _SESSION, _SESSION_REQUEST_COUNT = None, 0
+    return
+
+
+def _get_pool_stats(session):
+    ret = {'requests': 0, 'new_connections': 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            ret['requests'] += pool.num_requests
+            ret['new_connections'] += pool.num_connections
+    return ret
+
+
+def get_conn_stats():
+    """Counts of requests sent and connections opened by this process,
+    including since-recycled sessions. Requests which did not need a new
+    connection count as reused."""
+    ret = dict(_CLOSED_STATS)
+    if _SESSION is not None:
+        for key, val in _get_pool_stats(_SESSION).items():
+            ret[key] += val
+    ret['reused_connections'] = max(ret['requests'] - ret['new_connections'], 0)
+    return ret
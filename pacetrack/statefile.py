@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Reading and writing full state files.
+
+Full state files are gzipped JSON Lines: a header line with the
+summary fields (timestamp, campaign_results, goal_results, etc.), then
+one line per article. Version 1 files (without format_version) are a
+single JSON object, with the articles under article_results.
+"""
+from __future__ import unicode_literals
+
+import os
+import gzip
+import json
+
+from boltons.fileutils import atomic_save
+
+
+STATE_FORMAT_VERSION = 2
+
+
+def _iter_state_file_lines(json_path):
+    with open(json_path, 'rb') as f:
+        gzf = gzip.GzipFile(fileobj=f)
+        for line in gzf:
+            yield line
+        gzf.close()
+
+
+def iter_state_article_results(json_path):
+    """Yield the article result dicts in the full state file at
+    *json_path* one at a time, without loading the whole file."""
+    lines = _iter_state_file_lines(json_path)
+    header = json.loads(next(lines))
+    if 'article_results' in header:  # version 1
+        for article_data in header['article_results']:
+            yield article_data
+        return
+    for line in lines:
+        yield json.loads(line)
+    return
+
+
+def load_state_file(json_path, full=True):
+    """Load state data from a summary or full state file. article_results
+    is only included for full state files, and only if *full* is True."""
+    if not json_path.endswith('.gz'):
+        with open(json_path, 'rb') as f:
+            return json.load(f)
+
+    lines = _iter_state_file_lines(json_path)
+    state_data = json.loads(next(lines))
+    if 'article_results' in state_data:  # version 1
+        if not full:
+            state_data.pop('article_results')
+        return state_data
+    if full:
+        state_data['article_results'] = [json.loads(line) for line in lines]
+    lines.close()
+    return state_data
+
+
+def write_state_file(json_path, header, article_results, article_count=None):
+    """Atomically write a full state file, from *header* data and an
+    iterable of article result dicts, which are serialized one at a
+    time."""
+    header = dict(header, format_version=STATE_FORMAT_VERSION)
+    if article_count is not None:
+        header['article_count'] = article_count
+    with atomic_save(json_path) as f:
+        gzf = gzip.GzipFile(filename=os.path.basename(json_path), fileobj=f)
+        gzf.write(json.dumps(header, default=str) + '\n')
+        for article_data in article_results:
+            gzf.write(json.dumps(article_data, default=str) + '\n')
+        gzf.close()
+    return
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the MediaWiki API, for offline runs and load
+testing of campaign scans.
+
+Serves the parts of the action API (action=query with prop=info,
+revisions, templates, wbentityusage and pageassessments, and
+action=parse) and REST API (page/references) which pacetrack uses, at
+/w/api.php and /api/rest_v1/, from either:
+
+  * a SyntheticCorpus, which makes up a deterministic page for any
+    title asked for, so any campaign's article list can be scanned, or
+  * a RecordedCorpus, loaded from a JSON file of the form:
+
+      {"pages": {"<title>": {"revisions": [[<revid>, "<ISO8601 timestamp>"], ...],
+                             "templates": ["Template:Cite web", ...],
+                             "wikidata_item": "Q123",
+                             "assessments": {"Newspapers": {"class": "C", "importance": "Low"}},
+                             "references": {"references_by_id": {...}}}}}
+
+    with revisions oldest first, and talk pages as "Talk:<title>".
+
+Latency, errors and throttling are tunable, see StubAPI. Run with
+`pt serve-stub-api`, and point scans at it with `--api-url` or the
+PACETRACK_API_URL env var.
+
+The same corpus can be loaded into a SQLite stand-in for the wiki
+replicas with build_replica_db() (`pt build-stub-replica`), for scans
+with the replica backend, see dal.py.
+"""
+from __future__ import unicode_literals
+
+import json
+import time
+import random
+import hashlib
+import datetime
+import urlparse
+
+import gevent
+from gevent.pywsgi import WSGIServer
+from boltons.iterutils import unique
+
+from log import tlog
+
+
+DEFAULT_PORT = 8765
+ERROR_RETRY_AFTER = 1  # seconds, sent with throttled responses
+STUB_NOW = datetime.datetime(2026, 1, 1)  # latest synthetic revision date, fixed for determinism
+MISSING_RATIO = 0.02  # fraction of synthetic titles with no page
+
+WIKIPROJECT_TEMPLATES = ['Template:WikiProject Newspapers', 'Template:WikiProject Journalism',
+                         'Template:WikiProject United States', 'Template:WikiProject Companies']
+ARTICLE_TEMPLATES = ['Template:Cite web', 'Template:Cite news', 'Template:Reflist',
+                     'Template:Authority control', 'Template:Coord', 'Template:Citation needed',
+                     'Template:Commons category', 'Template:Official website']
+
+
+def _hash(text):
+    return int(hashlib.md5(text.encode('utf8')).hexdigest()[:12], 16)
+
+
+def normalize_title(title):
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def _format_ts(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class SyntheticCorpus(object):
+    """Makes up a page for every title, deterministically derived from
+    the title (and *seed*). Each page has a few revisions spread over
+    the years before STUB_NOW, so scans at older timestamps resolve to
+    older revisions."""
+    def __init__(self, seed=0):
+        self.seed = seed
+        self._revid_map = {}  # revid -> page, for revids handed out so far
+
+    def get_page(self, title):
+        title = normalize_title(title)
+        rand = random.Random(_hash('%s:%s' % (self.seed, title)))
+        if rand.random() < MISSING_RATIO:
+            return None
+        is_talk = title.startswith('Talk:')
+        page_id = _hash(title) % 100000000
+        revisions = []
+        days_ago = 0
+        for i in range(rand.randint(1, 6)):
+            days_ago += rand.randint(1, 720)
+            revisions.append((page_id * 10 + i, _format_ts(STUB_NOW - datetime.timedelta(days=days_ago))))
+        revisions.reverse()
+        if is_talk:
+            templates = [t for t in WIKIPROJECT_TEMPLATES if rand.random() < 0.5]
+        else:
+            templates = rand.sample(ARTICLE_TEMPLATES, rand.randint(0, len(ARTICLE_TEMPLATES)))
+            if rand.random() < 0.5:
+                templates.append('Template:Infobox newspaper')
+        ref_count = rand.randint(0, 40)
+        references = {'references_by_id': dict([('cite_note-%s' % i,
+                                                  {'content': {'html': ('<a href="https://www.wikidata.org/wiki/Q%s">'
+                                                                        % i) if rand.random() < 0.2 else 'ref'}})
+                                                 for i in range(ref_count)])}
+        page = {'pageid': page_id,
+                'title': title,
+                'revisions': [list(r) for r in revisions],
+                'templates': templates,
+                'wikidata_item': 'Q%s' % page_id if rand.random() < 0.9 else None,
+                'assessments': {} if is_talk else {'Newspapers': {'class': rand.choice('ABC'),
+                                                                  'importance': 'Low'}},
+                'references': references}
+        for revid, _ in page['revisions']:
+            self._revid_map[revid] = page
+        return page
+
+    def get_page_by_revid(self, revid):
+        return self._revid_map.get(revid)
+
+
+class RecordedCorpus(object):
+    def __init__(self, pages):
+        self.pages = {}
+        self._revid_map = {}
+        for i, (title, page) in enumerate(sorted(pages.items())):
+            page = dict(page, title=normalize_title(title))
+            page.setdefault('pageid', i + 1)
+            page.setdefault('templates', [])
+            page.setdefault('assessments', {})
+            page.setdefault('references', {'references_by_id': {}})
+            page.setdefault('wikidata_item', None)
+            self.pages[page['title']] = page
+            for revid, _ in page['revisions']:
+                self._revid_map[revid] = page
+
+    @classmethod
+    def from_path(cls, path):
+        with open(path, 'rb') as f:
+            return cls(json.load(f)['pages'])
+
+    def get_page(self, title):
+        return self.pages.get(normalize_title(title))
+
+    def get_page_by_revid(self, revid):
+        return self._revid_map.get(revid)
+
+
+class StubAPI(object):
+    """WSGI app serving a corpus in the shape of the MediaWiki API.
+
+    :param corpus: a SyntheticCorpus or RecordedCorpus
+    :param latency: mean seconds to wait before each response
+    :param latency_jitter: the wait varies uniformly by up to this
+    fraction of latency, in either direction
+    :param error_rate: fraction of requests failed with a 503
+    :param maxlag_rate: fraction of action API requests which get a
+    maxlag error (if they send maxlag)
+    :param throttle_rps: requests per second served before responding
+    with 429s, 0 for no limit
+    """
+    def __init__(self, corpus, latency=0.0, latency_jitter=0.5, error_rate=0.0,
+                 maxlag_rate=0.0, throttle_rps=0):
+        self.corpus = corpus
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.maxlag_rate = maxlag_rate
+        self.throttle_rps = throttle_rps
+
+        self._cur_second = 0
+        self._cur_second_count = 0
+        self.stats = {}
+
+    def _count(self, key):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _is_throttled(self):
+        if not self.throttle_rps:
+            return False
+        cur_second = int(time.time())
+        if cur_second != self._cur_second:
+            self._cur_second, self._cur_second_count = cur_second, 0
+        self._cur_second_count += 1
+        return self._cur_second_count > self.throttle_rps
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO'].decode('utf8')
+        params = dict([(k.decode('utf8'), v.decode('utf8'))
+                       for k, v in urlparse.parse_qsl(environ.get('QUERY_STRING', ''))])
+        self._count('requests')
+        if self.latency:
+            jitter = self.latency * self.latency_jitter
+            gevent.sleep(max(self.latency + random.uniform(-jitter, jitter), 0))
+
+        if self._is_throttled():
+            self._count('throttled')
+            return self._respond(start_response, '429 Too Many Requests',
+                                 {'error': {'code': 'ratelimited'}},
+                                 [('Retry-After', str(ERROR_RETRY_AFTER))])
+        if self.error_rate and random.random() < self.error_rate:
+            self._count('errors')
+            return self._respond(start_response, '503 Service Unavailable', {'error': {'code': 'unavailable'}})
+
+        if path.startswith('/api/rest_v1/page/references/'):
+            self._count('rest:references')
+            return self._get_references(start_response, path)
+        if path != '/w/api.php':
+            return self._respond(start_response, '404 Not Found', {'error': {'code': 'notfound'}})
+        if params.get('maxlag') and self.maxlag_rate and random.random() < self.maxlag_rate:
+            self._count('maxlag')
+            return self._respond(start_response, '200 OK',
+                                 {'error': {'code': 'maxlag', 'info': 'Waiting for a database server'}},
+                                 [('MediaWiki-API-Error', 'maxlag'), ('Retry-After', str(ERROR_RETRY_AFTER))])
+
+        action = params.get('action')
+        self._count('%s:%s' % (action, params.get('prop', '')))
+        if action == 'query':
+            body = self._query(params)
+        elif action == 'parse':
+            body = self._parse(params)
+        else:
+            body = {'error': {'code': 'badvalue', 'info': 'Unrecognized action: %r' % action}}
+        return self._respond(start_response, '200 OK', body)
+
+    def _respond(self, start_response, status, body, headers=()):
+        start_response(status.encode('ascii'), [(b'Content-Type', b'application/json')]
+                       + [(k.encode('ascii'), v.encode('ascii')) for k, v in headers])
+        return [json.dumps(body)]
+
+    def _get_references(self, start_response, path):
+        title, _, revid = path[len('/api/rest_v1/page/references/'):].rpartition('/')
+        page = self.corpus.get_page(urlparse.unquote(title.encode('utf8')).decode('utf8'))
+        if page is None:
+            return self._respond(start_response, '404 Not Found', {'type': 'not_found', 'title': 'Not found.'})
+        return self._respond(start_response, '200 OK', page['references'])
+
+    def _parse(self, params):
+        page = self.corpus.get_page_by_revid(int(params.get('oldid') or 0))
+        if page is None:
+            return {'error': {'code': 'nosuchrevid', 'info': 'There is no revision with ID %s.' % params.get('oldid')}}
+        return {'parse': {'title': page['title'],
+                          'pageid': page['pageid'],
+                          'templates': [{'ns': 10, 'exists': '', '*': t} for t in page['templates']]}}
+
+    def _query(self, params):
+        props = params.get('prop', '').split('|')
+        items, normalized, bad_revids = [], [], []
+        if params.get('titles'):
+            for title in params['titles'].split('|'):
+                norm_title = normalize_title(title)
+                if norm_title != title:
+                    normalized.append({'from': title, 'to': norm_title})
+                items.append((norm_title, self.corpus.get_page(title), None))
+        elif params.get('revids'):
+            for revid in params['revids'].split('|'):
+                page = self.corpus.get_page_by_revid(int(revid))
+                if page is None:
+                    bad_revids.append({'revid': int(revid)})
+                    continue
+                items.append((page['title'], page, int(revid)))
+
+        pages = []
+        for title, page, revid in items:
+            if page is None:
+                pages.append({'ns': 0, 'title': title, 'missing': True})
+                continue
+            out = {'pageid': page['pageid'], 'ns': 1 if title.startswith('Talk:') else 0, 'title': title}
+            revisions = page['revisions']
+            if 'info' in props:
+                out['lastrevid'] = revisions[-1][0]
+            if 'revisions' in props:
+                if revid:
+                    out['revisions'] = [{'revid': revid}]
+                else:
+                    if params.get('rvstart'):  # the latest revision at rvstart
+                        revisions = [r for r in revisions if r[1] <= params['rvstart']]
+                    if revisions:
+                        out['revisions'] = [{'revid': revisions[-1][0], 'timestamp': revisions[-1][1]}]
+            if 'templates' in props and page['templates']:
+                out['templates'] = [{'ns': 10, 'title': t} for t in page['templates']]
+            if 'wbentityusage' in props and page['wikidata_item']:
+                out['wbentityusage'] = {page['wikidata_item']: {'aspects': ['S', 'O']}}
+            if 'pageassessments' in props and page['assessments']:
+                out['pageassessments'] = page['assessments']
+            pages.append(out)
+
+        if params.get('formatversion') == '2':
+            query = {'pages': pages}
+            if normalized:
+                query['normalized'] = normalized
+            if bad_revids:
+                query['badrevids'] = bad_revids
+            return {'batchcomplete': True, 'query': query}
+        # formatversion 1 keys pages by page id, negative for missing pages
+        pages_by_id = {}
+        for i, page in enumerate(pages):
+            if page.get('missing'):
+                page['missing'] = ''
+                pages_by_id[str(-(i + 1))] = page
+            else:
+                pages_by_id[str(page['pageid'])] = page
+        return {'batchcomplete': '', 'query': {'pages': pages_by_id}}
+
+
+def _split_prefixed_title(title, prefix_ns_map):
+    prefix, sep, rest = title.partition(':')
+    if sep and prefix in prefix_ns_map:
+        return prefix_ns_map[prefix], rest.replace(' ', '_')
+    return 0, title.replace(' ', '_')
+
+
+def build_replica_db(corpus, db_path, titles=None):
+    """Load *corpus* into a new SQLite stand-in for the wiki replicas
+    at *db_path*, with the tables in dal.REPLICA_SCHEMA_PATH, so that
+    the replica backend and the StubAPI serve the same pages.
+
+    A SyntheticCorpus makes pages up as they're asked for, so pass the
+    article *titles* to load, along with their talk pages. A
+    RecordedCorpus loads all of its pages by default.
+    """
+    import sqlite3
+    from dal import REPLICA_SCHEMA_PATH, to_mw_timestamp
+
+    if titles is None:
+        titles = sorted(corpus.pages)
+    else:
+        titles = [normalize_title(t) for t in titles]
+        titles = unique(titles + ['Talk:' + t for t in titles if not t.startswith('Talk:')])
+    conn = sqlite3.connect(db_path)
+    with open(REPLICA_SCHEMA_PATH, 'rb') as f:
+        conn.executescript(f.read().decode('utf8'))
+    linktarget_ids, project_ids = {}, {}
+    page_count = 0
+    for title in titles:
+        page = corpus.get_page(title)
+        if page is None:
+            continue
+        page_id, revisions = page['pageid'], page['revisions']
+        ns, db_title = _split_prefixed_title(page['title'], {'Talk': 1})
+        try:
+            conn.execute('INSERT INTO page VALUES (?, ?, ?, ?)', (page_id, ns, db_title, revisions[-1][0]))
+        except sqlite3.IntegrityError:
+            continue  # synthetic page ids (and so revids) can collide, first page wins
+        page_count += 1
+        conn.executemany('INSERT INTO revision VALUES (?, ?, ?)',
+                         [(revid, page_id, to_mw_timestamp(ts)) for revid, ts in revisions])
+        for template in page['templates']:
+            target = _split_prefixed_title(template, {'Template': 10, 'Module': 828})
+            if target not in linktarget_ids:
+                linktarget_ids[target] = len(linktarget_ids) + 1
+                conn.execute('INSERT INTO linktarget VALUES (?, ?, ?)', (linktarget_ids[target],) + target)
+            conn.execute('INSERT INTO templatelinks VALUES (?, ?, ?)', (page_id, linktarget_ids[target], ns))
+        if page['wikidata_item']:
+            # like the API, only the sitelink ("S") usage counts
+            conn.executemany('INSERT INTO wbc_entity_usage (eu_entity_id, eu_aspect, eu_page_id) VALUES (?, ?, ?)',
+                             [(page['wikidata_item'], aspect, page_id) for aspect in ('S', 'O')])
+        for project, assessment in sorted(page['assessments'].items()):
+            if project not in project_ids:
+                project_ids[project] = len(project_ids) + 1
+                conn.execute('INSERT INTO page_assessments_projects VALUES (?, ?)', (project_ids[project], project))
+            conn.execute('INSERT INTO page_assessments VALUES (?, ?, ?, ?, ?)',
+                         (page_id, project_ids[project], assessment.get('class'),
+                          assessment.get('importance'), revisions[-1][0]))
+    conn.commit()
+    conn.close()
+    tlog.critical('build_replica_db', db_path=db_path, page_count=page_count).success(
+        'loaded {page_count} pages into {db_path}')
+    return page_count
+
+
+def serve(app, host='127.0.0.1', port=DEFAULT_PORT):
+    "Start serving *app* in the background, returns the started WSGIServer."
+    server = WSGIServer((host, port), app, log=None)
+    server.start()
+    tlog.critical('stub_api_start', host=host, port=port).success(
+        'serving stub API at http://{host}:{port}/')
+    return server
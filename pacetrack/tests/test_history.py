@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+
+from pacetrack.goals import UNKNOWN_RESULT
+from pacetrack.history import HistoryStore
+
+
+HEADER = {'timestamp': '2018-10-01T00:00:00',
+          'save_date': '2018-10-01T00:00:00',
+          'campaign_results': {},
+          'goal_results': {}}
+GOAL_RESULT = {'cur': 2, 'target': 3, 'cmp': 'ge', 'done': False,
+               'remaining': 1, 'progress': 2 / 3.0}
+ARTICLE_RESULTS = [{'title': 'Alpha', 'rev_id': 1, 'talk_rev_id': None,
+                    'results': {'citations': dict(UNKNOWN_RESULT)}},
+                   {'title': 'Beta', 'rev_id': 2, 'talk_rev_id': 3,
+                    'results': {'citations': GOAL_RESULT}}]
+
+
+def _round_trip(goals=None):
+    tmp_path = tempfile.mkdtemp()
+    try:
+        HistoryStore(tmp_path, goals=goals).append(HEADER, ARTICLE_RESULTS)
+        return list(HistoryStore(tmp_path).iter_article_results(0))
+    finally:
+        shutil.rmtree(tmp_path)
+
+
+def test_round_trip_first_result_unknown():
+    assert _round_trip() == ARTICLE_RESULTS
+
+
+def test_round_trip_goal_config():
+    goals = [{'name': 'Citations', 'metric': 'citation_count',
+              'target': {'value': 3, 'cmp': 'ge'}}]
+    assert _round_trip(goals) == ARTICLE_RESULTS
@@ -10,57 +10,134 @@ from __future__ import unicode_literals, print_function, division
 
 import os
 import sys
-import gzip
 import json
 import uuid
+import time
+import hashlib
 import datetime
-import operator
+import traceback
+import multiprocessing
+from StringIO import StringIO
 from pipes import quote as shell_quote
+from contextlib import contextmanager
 from argparse import ArgumentParser
 from itertools import izip_longest
-
-import urllib3
-urllib3.disable_warnings()  # for labs
+from collections import deque
 
 import attr
-from ruamel import yaml
-from ashes import AshesEnv
 from boltons.strutils import slugify
 from boltons.fileutils import atomic_save, iter_find_files, mkdir_p
-from boltons.iterutils import unique, partition, first
+from boltons.iterutils import unique, partition, first, bucketize, chunked
 from boltons.timeutils import isoparse, parse_timedelta
-from tqdm import tqdm
-from glom import glom, T
-
-import gevent.monkey
-gevent.monkey.patch_all()
 
-from log import tlog, LOG_PATH, build_stream_sink
+from log import tlog, LOG_PATH, build_stream_sink, default_file_sink, write_log_text
+from session import APIError, DEFAULT_RATE_LIMIT, DEFAULT_TIMEOUT
+from manifest import StateManifest, to_timestamp_key
+from statefile import load_state_file, iter_state_article_results, write_state_file
+from article_list import load_sparql_json_titles, iter_unique_titles, save_title_list, normalize_title
+from run_stats import RunStats, get_active_run_stats
+from utils import TEMPLATE_PATH, STATIC_PATH
+from goals import UNKNOWN_RESULT, compile_goals, get_fetch_plan, eval_article_goals
 import metrics
 
 
-CUR_PATH = os.path.dirname(os.path.abspath(__file__))
-TEMPLATE_PATH = CUR_PATH + '/templates/'
-PROJECT_PATH = os.path.dirname(CUR_PATH)
-CAMPAIGNS_PATH = PROJECT_PATH + '/campaigns/'
-STATIC_PATH = PROJECT_PATH + '/static/'
-
 RUN_UUID = uuid.uuid4()
 UPDATED_DT_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 DEBUG = False
 
 DEFAULT_CARD = 'https://upload.wikimedia.org/wikipedia/commons/8/81/WikiSplat.png'
+DEFAULT_ARTICLE_TIMEOUT = 300  # seconds for all of an article's lookups, see scan_articles()
+DEFAULT_CONCURRENCY = 50  # number of articles scanned at once, matches metrics.MAX_BATCH_SIZE
+BACKEND_TYPES = ('api', 'replica')  # where scans get article data, see dal.py
 
 # these paths are relative to the campaign directory
 STATE_FULL_PATH_TMPL = '/data/%Y%m/state_full_%Y%m%d_%H%M%S.json.gz'
 STATE_PATH_TMPL = '/data/%Y%m/state_%Y%m%d_%H%M%S.json'
 STATE_FULL_FN_GLOB = 'state_full_*.json.gz'
 STATE_FN_GLOB = 'state_*.json'
-
-
-ASHES_ENV = AshesEnv(TEMPLATE_PATH, filters={'percentage': lambda n: round(n*100, 2)})
-ASHES_ENV.load_all()
+SERIES_CACHE_FILENAME = 'series_cache.json'
+SERIES_CACHE_VERSION = 1
+PACE_CACHE_FILENAME = 'pace_cache.json'
+PACE_CACHE_VERSION = 1
+# paged article list files, relative to the campaign's static
+# directory, see PTCampaign.render_article_list()
+ARTICLE_PAGE_HTML_TMPL = 'articles_%d.html'  # page 1 is articles.html
+ARTICLE_PAGES_DIRNAME = 'articles'
+ARTICLE_SHARD_TMPL = ARTICLE_PAGES_DIRNAME + '/shard_%04d.json'
+ARTICLE_NOT_DONE_SHARD_TMPL = ARTICLE_PAGES_DIRNAME + '/not_done_%s_%04d.json'
+ARTICLE_INDEX_PATH = ARTICLE_PAGES_DIRNAME + '/index.json'
+RENDER_CACHE_FILENAME = 'render_cache.json'  # kept alongside the rendered files
+RENDER_CACHE_VERSION = 1  # bump when rendering changes in ways the render keys don't capture
+
+
+_ASHES_ENV = None
+
+
+def get_ashes_env():
+    "The template environment, with all templates loaded on first use."
+    global _ASHES_ENV
+    if _ASHES_ENV is None:
+        from ashes import AshesEnv
+        _ASHES_ENV = AshesEnv(TEMPLATE_PATH, filters={'percentage': lambda n: round(n*100, 2)})
+        _ASHES_ENV.load_all()
+    return _ASHES_ENV
+
+
+def patch_gevent():
+    """Monkey-patch the standard library for gevent, which scans need
+    for concurrent requests. It's a good part of startup time, so
+    it's only done once a scan starts, see scan_articles()."""
+    import gevent.monkey
+    if not gevent.monkey.is_module_patched('socket'):
+        gevent.monkey.patch_all()
+
+
+_TEMPLATE_DIGESTS = {}
+
+
+def get_template_digest(template_name):
+    "SHA1 of a template file's contents, read once per process."
+    if template_name not in _TEMPLATE_DIGESTS:
+        with open(TEMPLATE_PATH + template_name, 'rb') as f:
+            _TEMPLATE_DIGESTS[template_name] = hashlib.sha1(f.read()).hexdigest()
+    return _TEMPLATE_DIGESTS[template_name]
+
+
+def get_render_key(template_name, key_data):
+    """Content hash of everything a page is rendered from: the
+    template file and *key_data*, which must not include anything
+    which changes every run (e.g., date_updated)."""
+    key_json = json.dumps({'version': RENDER_CACHE_VERSION,
+                           'template': get_template_digest(template_name),
+                           'data': key_data}, sort_keys=True, default=unicode)
+    return hashlib.sha1(key_json.encode('utf8')).hexdigest()
+
+
+def is_render_current(static_path, name, render_key, output_paths):
+    """Whether the outputs of render *name* under *static_path* were
+    rendered with *render_key* and are still there, in which case
+    rendering can be skipped. See mark_rendered()."""
+    cache_path = static_path + RENDER_CACHE_FILENAME
+    if not os.path.exists(cache_path):
+        return False
+    with open(cache_path, 'rb') as f:
+        cache = json.load(f)
+    if cache.get(name) != render_key:
+        return False
+    return all([os.path.exists(path) for path in output_paths])
+
+
+def mark_rendered(static_path, name, render_key):
+    cache_path = static_path + RENDER_CACHE_FILENAME
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cache = json.load(f)
+    cache[name] = render_key
+    with atomic_save(cache_path) as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    return
 
 
 def to_unicode(obj):
@@ -70,6 +147,12 @@ def to_unicode(obj):
         return unicode(obj, encoding='utf8')
 
 
+# article scan statuses
+STATUS_COMPLETE = 'complete'  # everything planned was fetched
+STATUS_PARTIAL = 'partial'  # some attributes failed or timed out, see PTArticle.missing
+STATUS_FAILED = 'failed'  # the revision lookup failed, or the scan ran out of time
+
+
 @attr.s
 class PTArticle(object):
     lang = attr.ib()
@@ -90,48 +173,239 @@ class PTArticle(object):
     wikidata_item = attr.ib(default=attr.Factory(list), repr=False)
 
     results = attr.ib(default=None, repr=False)
+    fetched = attr.ib(default=attr.Factory(list), repr=False)  # names of the attributes above fetched in the scan
+    missing = attr.ib(default=attr.Factory(list), repr=False)  # planned attributes which failed or timed out
+    status = attr.ib(default=STATUS_COMPLETE)  # complete, partial or failed, see scan_articles()
 
 
-def eval_one_article_goal(pta, goal):
-    ret = {}
-    metric_func = getattr(metrics, goal['metric'], None)
-    if metric_func is None:
-        raise RuntimeError('unexpected metric name: %r' % goal['metric'])
-    metric_args = goal.get('metric_args', {})
-    metric_val = metric_func(pta, **metric_args)
-    target_val = goal['target']['value']
-    cmp_name = goal['target'].get('cmp', 'ge')
-    if cmp_name == 'bool':
-        return {'done': bool(metric_val)}
-    cmp_func = getattr(operator, cmp_name, None)
-    ret['cur'] = metric_val
-    ret['target'] = target_val
-    ret['cmp'] = cmp_name
-    done = cmp_func(metric_val, target_val)
-    ret['done'] = done
-
-    start_val = 0.0  # TODO
-
-    remaining = 0.0 if done else target_val - metric_val
-    ret['remaining'] = remaining
-    progress = (metric_val - start_val) / (target_val - start_val)
-    ret['progress'] = progress
-
-    return ret
-
-
-def eval_article_goals(pta, goals):
-    ret = {}
-    for goal in goals:
-        # maybe default name to metric name, need to precheck they don't collide
-        ret[slugify(goal['name'])] = eval_one_article_goal(pta, goal)
-    return ret
+# PTArticle attributes determined by rev_id and talk_rev_id, which a
+# scan can fetch. States saved before "fetched" was recorded fetched
+# all of them.
+FETCHABLE_ATTRS = ('templates', 'talk_templates', 'wikiprojects',
+                   'assessments', 'citations', 'wikidata_item')
 
 
 class StateNotFound(Exception):
     pass
 
 
+def parse_backend_config(backend):
+    """Normalize a campaign's backend config, either a backend type
+    ("api" or "replica") or a dict with a type and its settings (see
+    dal.connect_replica()), to a dict."""
+    if not backend:
+        backend = 'api'
+    if not isinstance(backend, dict):
+        backend = {'type': backend}
+    backend = dict(backend)
+    backend.setdefault('type', 'api')
+    if backend['type'] not in BACKEND_TYPES:
+        raise ValueError('expected backend type to be one of %r, not %r' % (BACKEND_TYPES, backend['type']))
+    return backend
+
+
+def _build_scan_funcs(fetcher, fetch_plan):
+    # the lookups and bookkeeping for a scan of articles with the same
+    # fetch plan, see scan_articles()
+    revid_funcs = {'rev_id': fetcher.get_revid,
+                   'talk_rev_id': fetcher.get_talk_revid}
+    revid_funcs = dict([(k, v) for k, v in revid_funcs.items() if k in fetch_plan])
+    attr_funcs = {'templates': fetcher.get_templates,
+                  'talk_templates': fetcher.get_talk_templates,
+                  'assessments': fetcher.get_assessments,
+                  'citations': metrics.get_citations,
+                  'wikidata_item': fetcher.get_wikidata_item}
+    skipped_count = len([k for k in attr_funcs if k not in fetch_plan])
+    attr_funcs = dict([(k, v) for k, v in attr_funcs.items() if k in fetch_plan])
+    fetched_attrs = [a for a in FETCHABLE_ATTRS if a in fetch_plan]
+    # attributes carried forward need all their revisions unchanged
+    carryable_attrs = [a for a in FETCHABLE_ATTRS
+                       if metrics.resolve_attr_dependencies([a]) & set(['rev_id', 'talk_rev_id'])
+                       <= set(revid_funcs)]
+    return {'plan': fetch_plan,
+            'revid_funcs': revid_funcs,
+            'attr_funcs': attr_funcs,
+            'skipped_count': skipped_count,
+            'fetched_attrs': fetched_attrs,
+            'carryable_attrs': carryable_attrs}
+
+
+def _get_stats_delta(start_stats, end_stats):
+    return dict([(k, v - start_stats.get(k, 0)) for k, v in end_stats.items()])
+
+
+def scan_articles(lang, timestamp, title_plans, prev_article_map=None,
+                  concurrency=DEFAULT_CONCURRENCY, rate_limit=None, rev_cache=None, desc='Scanning',
+                  request_timeout=None, article_timeout=DEFAULT_ARTICLE_TIMEOUT, time_budget=None,
+                  backend=None):
+    """Fetch articles via the API (or the replica DB, see *backend*),
+    returning a list of PTArticles (without goal results) in the same
+    order as *title_plans*.
+
+    :param title_plans: list of (title, fetch plan) pairs, the fetch
+    plan being the set of attributes to fetch, see goals.get_fetch_plan()
+    :param prev_article_map: map of title to article result dict from
+    an earlier state. Articles whose revision and talk page revision
+    are unchanged, and which had all the planned attributes fetched,
+    are carried forward instead of fetched again.
+    :param rev_cache: a RevisionCache, closed when the scan is done
+    :param request_timeout: seconds to wait on a single API request
+    (per attempt), see session.configure_session()
+    :param article_timeout: seconds an article's lookups may take, in
+    all. Lookups still running after that are cancelled, and the
+    article's status is partial (or failed, for revision lookups).
+    :param time_budget: seconds the whole scan may take. Once it runs
+    out, lookups in flight are cancelled, and the remaining articles
+    are marked failed without being fetched.
+    :param backend: backend config dict, see parse_backend_config().
+    Scans use the API by default.
+
+    Goals which depend on an article's missing attributes are counted
+    as unknown, see goals.eval_article_goals().
+    """
+    patch_gevent()
+    # imported here, as only scans need them
+    import gevent
+    from gevent.pool import Pool
+    from tqdm import tqdm
+    from dal import get_fetcher
+    from session import configure_session, get_conn_stats, get_request_stats
+
+    prev_article_map = prev_article_map or {}
+    scan_deadline = time.time() + time_budget if time_budget else None
+    article_list = []
+
+    base_desc = '%s @ %s' % (desc, timestamp.isoformat().split('.')[0])
+    progress = tqdm(total=len(title_plans),
+                    desc=base_desc,
+                    disable=None,  # autodisable on non-tty
+                    unit='article')
+
+    run_stats = get_active_run_stats()
+
+    def async_pta_update(pta, attr_func_map, deadline):
+        "Returns the names of the attributes which failed or missed the deadline."
+        jobs = {}
+        for attr, func in attr_func_map.items():
+            # wrap a plain function, as func may be a bound fetcher method
+            _debug_log_func = tlog.wrap('debug', func.__name__)(lambda pta, func=func: func(pta))
+            if run_stats is not None:
+                _debug_log_func = run_stats.wrap_metric(func.__name__, _debug_log_func)
+            jobs[attr] = gevent.spawn(lambda pta=pta, attr=attr, func=_debug_log_func: setattr(pta, attr, func(pta)))
+        gevent.joinall(jobs.values(), timeout=max(deadline - time.time(), 0))
+        failed = []
+        for attr_name, job in jobs.items():
+            if not job.ready():
+                job.kill(block=False)
+                stats['timeouts'] += 1
+            elif job.successful():
+                continue
+            else:
+                stats['errors'] += 1
+            failed.append(attr_name)
+        return sorted(failed)
+
+    # lookups with a multi-title form go through the fetcher, which
+    # batches them across all the articles in flight
+    fetcher = get_fetcher(lang, backend)
+    configure_session(pool_size=concurrency, rate_limit=rate_limit, timeout=request_timeout)
+    metrics.set_rev_cache(rev_cache)
+    # the session's stats are process-wide, this scan's are the difference
+    start_conn_stats, start_request_stats = get_conn_stats(), get_request_stats()
+
+    plan_funcs_map = {}
+    stats = {'carried': 0, 'fetched': 0, 'calls_saved': 0, 'timeouts': 0, 'errors': 0}
+    status_counts = dict([(status, 0) for status in (STATUS_COMPLETE, STATUS_PARTIAL, STATUS_FAILED)])
+
+    def scan_article(title_plan):
+        title, fetch_plan = title_plan
+        fetch_plan = frozenset(fetch_plan)
+        if fetch_plan not in plan_funcs_map:
+            plan_funcs_map[fetch_plan] = _build_scan_funcs(fetcher, fetch_plan)
+        plan_funcs = plan_funcs_map[fetch_plan]
+        revid_funcs = plan_funcs['revid_funcs']
+
+        pta = PTArticle(lang=lang, title=title, timestamp=timestamp)
+        pta.talk_title = 'Talk:' + title
+        deadline = time.time() + article_timeout
+        if scan_deadline is not None:
+            deadline = min(deadline, scan_deadline)
+        if deadline <= time.time():  # out of time, skip the lookups
+            pta.missing = sorted(revid_funcs) + plan_funcs['fetched_attrs']
+            pta.status = STATUS_FAILED
+            return pta
+        failed = async_pta_update(pta, revid_funcs, deadline)
+        if 'talk_rev_id' not in revid_funcs:
+            stats['calls_saved'] += 1
+        if failed:
+            pta.missing = failed + plan_funcs['fetched_attrs']
+            pta.status = STATUS_FAILED
+            return pta
+
+        prev_article = prev_article_map.get(title)
+        prev_fetched = None
+        if prev_article and all([getattr(pta, k) == prev_article[k] for k in revid_funcs]):
+            prev_fetched = prev_article.get('fetched', FETCHABLE_ATTRS)
+        if prev_fetched is not None and set(plan_funcs['fetched_attrs']) <= set(prev_fetched):
+            pta.fetched = [a for a in prev_fetched if a in plan_funcs['carryable_attrs']]
+            for attr_name in pta.fetched:
+                setattr(pta, attr_name, prev_article[attr_name])
+            stats['carried'] += 1
+        elif pta.rev_id:
+            failed = async_pta_update(pta, plan_funcs['attr_funcs'], deadline)
+            if 'wikiprojects' in fetch_plan:
+                if 'talk_templates' in failed:
+                    failed.append('wikiprojects')
+                else:
+                    pta.wikiprojects = metrics.get_wikiprojects(pta)  # relies on templates (no network)
+            pta.fetched = [a for a in plan_funcs['fetched_attrs'] if a not in failed]
+            if failed:
+                pta.missing = failed
+                pta.status = STATUS_PARTIAL
+            stats['fetched'] += 1
+            stats['calls_saved'] += plan_funcs['skipped_count']
+        return pta
+
+    # imap keeps up to `concurrency` articles in flight, but yields
+    # them in title list order, keeping the saved state deterministic.
+    # The fetcher may want more in flight, to fill its batches.
+    pool = Pool(max(concurrency, fetcher.min_concurrency))
+    try:
+        for pta in pool.imap(scan_article, title_plans):
+            progress.set_description(base_desc + ' ({:16.16})'.format(pta.title))
+            progress.update()
+            status_counts[pta.status] += 1
+            article_list.append(pta)
+    finally:
+        progress.close()
+        pool.kill()  # if a scan failed, stop the rest before closing the cache
+        fetcher.close()  # also stops batches still in flight
+        metrics.set_rev_cache(None)
+        if rev_cache:
+            rev_cache.log_stats()
+            rev_cache.close()
+    fetcher.log_stats()
+    all_plans = set().union(*plan_funcs_map.keys()) if plan_funcs_map else set()
+    tlog.info('fetch_plan', fetched=sorted(all_plans), skipped=sorted(set(metrics.ATTR_DEPENDENCIES) - all_plans),
+              calls_saved=stats['calls_saved']).success(
+        'fetched {fetched}, skipped {skipped}, saving {calls_saved} lookups')
+    if prev_article_map:
+        tlog.info('incremental_scan', total=len(article_list), **stats).success(
+            '{carried} of {total} articles unchanged since the previous state, carried forward')
+    tlog.info('http_conn_stats', **_get_stats_delta(start_conn_stats, get_conn_stats())).success(
+        '{requests} requests, {reused_connections} on reused connections, {new_connections} new connections')
+    tlog.info('http_request_stats', **_get_stats_delta(start_request_stats, get_request_stats())).success(
+        '{retries} retries, {throttled} throttled, {rate_limit_wait:.1f}s rate limited, {backoff_wait:.1f}s backing off')
+    budget_exhausted = scan_deadline is not None and time.time() >= scan_deadline
+    tlog.info('article_status', timeouts=stats['timeouts'], errors=stats['errors'],
+              budget_exhausted=budget_exhausted, **status_counts).success(
+        '{complete} articles complete, {partial} partial, {failed} failed'
+        ' ({timeouts} lookups timed out, {errors} errored, budget exhausted: {budget_exhausted})')
+    if article_list and status_counts[STATUS_FAILED] == len(article_list):
+        raise APIError('all %s articles failed to scan, see the log for errors' % len(article_list))
+    return article_list
+
+
 def get_state_filepaths(data_dir, full=True):
     pattern = STATE_FULL_FN_GLOB if full else STATE_FN_GLOB
     return sorted(iter_find_files(data_dir, pattern))
@@ -144,11 +418,25 @@ class PTCampaignState(object):
     timestamp = attr.ib()
     campaign_results = attr.ib()
     goal_results = attr.ib(repr=False)
-    article_results = attr.ib(default=None, repr=False)
+    _article_results = attr.ib(default=None, repr=False)  # see article_results
     article_list = attr.ib(default=None, repr=False)
     _state_file_save_date = attr.ib(default=None)
+    _full_state_path = attr.ib(default=None, repr=False)
+
+    @property
+    def article_results(self):
+        """Per-article results, loaded from the full state file on first
+        access when the state was loaded from a summary file."""
+        if self._article_results is None:
+            if self.article_list is not None:
+                self._article_results = [attr.asdict(a) for a in self.article_list]
+            elif self._full_state_path:
+                with tlog.info('load_article_results', path=self._full_state_path):
+                    self._article_results = list(iter_state_article_results(self._full_state_path))
+        return self._article_results
 
     def get_results_struct(self):
+        from glom import glom, T
         result_spec = {
             'title': 'title',
             'rev_id': 'rev_id',
@@ -169,118 +457,117 @@ class PTCampaignState(object):
 
     @classmethod
     def from_json_path(cls, campaign, json_path, full):
+        """Load a state from a summary or full state file. Unless *full*
+        is True, article_results are only loaded on first access."""
         if not json_path:
             raise ValueError('missing json_path')
 
-        with open(json_path, 'rb') as f:
-            if json_path.endswith('.gz'):
-                f = gzip.GzipFile(fileobj=f)
-            state_data = json.load(f)
+        state_data = load_state_file(json_path, full=full)
 
         campaign_results = state_data.get('campaign_results')
         if not campaign_results:
             print('WARNING: old data, no campaign results present, delete data and reupdate')
+        timestamp = isoparse(state_data['timestamp'])
         ret = cls(campaign=campaign,
-                  timestamp=isoparse(state_data['timestamp']),
+                  timestamp=timestamp,
                   campaign_results=campaign_results,
                   goal_results=state_data['goal_results'],
-                  article_results=state_data['article_results'] if full else None,
-                  # title_list=state_data['title_list'],  # no use for this yet
-                  state_file_save_date=state_data['save_date'])
+                  article_results=state_data.get('article_results') if full else None,
+                  # title_list_hash=state_data.get('title_list_hash'),  # no use for this yet
+                  state_file_save_date=state_data['save_date'],
+                  full_state_path=campaign.base_path + timestamp.strftime(STATE_FULL_PATH_TMPL))
         return ret
 
     @classmethod
     def from_latest(cls, campaign, full=True):
-        data_base_dir = campaign.base_path + '/data/'
-        data_dirs = next(os.walk(data_base_dir))[1]
-        data_dirs = [d for d in data_dirs if d.isdigit()]  # only numeric dir names
-        if not data_dirs:
-            raise StateNotFound('no numeric data directories found in %r' % data_base_dir)
-        latest_dir = data_base_dir + sorted(data_dirs)[-1]
-
-        latest_file_path = get_state_filepaths(latest_dir, full=full)[-1]
+        latest_file_path = campaign.get_latest_state_path(full=full)
+        if latest_file_path is None:
+            raise StateNotFound('no state found for campaign %r' % (campaign,))
 
         return cls.from_json_path(campaign, latest_file_path, full=full)
 
     @classmethod
     def from_timestamp(cls, campaign, timestamp, full=True):
-        strf_tmpl = STATE_FULL_PATH_TMPL if full else STATE_PATH_TMPL
-
-        # this handles when a date object is passed in for timestamp
-        # (instead of a datetime)
-        strf_tmpl = strf_tmpl.replace('000000', '*')
-
-        start_pattern = timestamp.strftime(strf_tmpl)
-        dir_path = campaign.base_path + os.path.split(start_pattern)[0]
-        file_paths = sorted(iter_find_files(dir_path, os.path.split(start_pattern)[1]))
-        try:
-            first_path = file_paths[0]
-        except IndexError:
+        # timestamp may be a date, for the first state saved that day
+        entry = campaign.get_state_manifest().get_at(timestamp, full=full)
+        if entry is None:
             raise StateNotFound('no state found for campaign %r at timestamp %s'
                                 % (campaign, timestamp))
+        state_path = entry['full_path'] if full else entry['path']
 
-        return cls.from_json_path(campaign, first_path, full=full)
+        return cls.from_json_path(campaign, campaign.base_path + state_path, full=full)
 
     @classmethod
-    def from_api(cls, campaign, timestamp=None):
+    def from_api(cls, campaign, timestamp=None, prev_state=None):
+        """Scan all of the campaign's articles via the campaign's backend
+        (the API, by default).
+
+        If *prev_state* is passed, only articles whose revision or talk
+        page revision changed since prev_state (or which are new to
+        the article list) are fetched. The rest carry their fetched
+        attributes forward from prev_state.
+        """
         timestamp = timestamp if timestamp is not None else datetime.datetime.utcnow()
+        goal_evaluators = compile_goals(campaign.goals)
+        fetch_plan = get_fetch_plan(goal_evaluators)
+        prev_article_map = {}
+        if prev_state is not None:
+            # states saved before titles were normalized hold raw titles
+            prev_article_map = dict([(normalize_title(a['title']), a) for a in prev_state.article_results])
+
+        article_list = scan_articles(campaign.lang, timestamp,
+                                     [(title, fetch_plan) for title in campaign.article_title_list],
+                                     prev_article_map=prev_article_map,
+                                     concurrency=campaign.concurrency,
+                                     rate_limit=campaign.rate_limit,
+                                     rev_cache=campaign.get_rev_cache(),
+                                     desc='Scanning %s' % campaign.name,
+                                     request_timeout=campaign.request_timeout,
+                                     article_timeout=campaign.article_timeout,
+                                     time_budget=campaign.get_scan_time_budget(),
+                                     backend=campaign.backend)
+        return cls.from_articles(campaign, timestamp, article_list, goal_evaluators)
+
+    @classmethod
+    def from_articles(cls, campaign, timestamp, article_list, goal_evaluators=None):
+        """Evaluate the campaign's goals against scanned PTArticles (see
+        scan_articles()), setting their results, and summarize them
+        into a new state.
+
+        Goals are evaluated for articles carried forward from an
+        earlier state, too (no network needed), so that changes to the
+        goal config take effect.
+        """
+        if goal_evaluators is None:
+            goal_evaluators = compile_goals(campaign.goals)
         ret = cls(campaign=campaign,
                   timestamp=timestamp,
                   campaign_results=None,
                   goal_results=None,
                   article_results=None)
-
-        article_list = []
-        article_title_list = campaign.article_title_list
-
-        base_desc = 'Scanning %s @ %s' % (campaign.name, timestamp.isoformat().split('.')[0])
-        article_title_list = tqdm(article_title_list,
-                                  desc=base_desc,
-                                  disable=None,  # autodisable on non-tty
-                                  unit='article')
-
-        def async_pta_update(pta, attr_func_map):
-            jobs = []
-            for attr, func in attr_func_map.items():
-                _debug_log_func = tlog.wrap('debug')(func)
-                cur = gevent.spawn(lambda pta=pta, attr=attr, func=_debug_log_func: setattr(pta, attr, func(pta)))
-                jobs.append(cur)
-            gevent.wait(jobs, timeout=20)
-            return
-
-        for title in article_title_list:
-            new_desc = base_desc + ' ({:16.16})'.format(title)
-            article_title_list.set_description(new_desc)
-            pta = PTArticle(lang=campaign.lang, title=title, timestamp=timestamp)
-            pta.talk_title = 'Talk:' + title
-            async_pta_update(pta, {'rev_id': metrics.get_revid,
-                                   'talk_rev_id': metrics.get_talk_revid})
-
-            if pta.rev_id:
-                async_pta_update(pta, {'templates': metrics.get_templates,
-                                       'talk_templates': metrics.get_talk_templates,
-                                       'assessments': metrics.get_assessments,
-                                       'citations': metrics.get_citations,
-                                       'wikidata_item': metrics.get_wikidata_item})
-                pta.wikiprojects = metrics.get_wikiprojects(pta)  # relies on templates (no network)
-
-            pta.results = eval_article_goals(pta, campaign.goals)
-
-            article_list.append(pta)
+        for pta in article_list:
+            pta.results = eval_article_goals(pta, goal_evaluators)
         ret.article_list = article_list
 
         gres = {}  # goal results
         for goal in campaign.goals:
             key = slugify(goal['name'])
             target_ratio = float(goal.get('ratio', 1.0))
+            # unknown results (see goals.eval_article_goals()) count
+            # toward neither done nor not done
             results = [a.results[key]['done'] for a in article_list]
             # TODO: average/median metric value
 
-            done, not_done = partition(results)
+            known, unknown = partition(results, lambda done: done is not None)
+            done, not_done = partition(known)
             # TODO: need to integrate start state for progress tracking
-            ratio = 1.0 if not not_done else float(len(done)) / len(article_list)
+            if not not_done:
+                ratio = 1.0 if (done or not unknown) else 0.0
+            else:
+                ratio = float(len(done)) / len(known)
             gres[key] = {'done_count': len(done),
                          'not_done_count': len(not_done),
+                         'unknown_count': len(unknown),
                          'total_count': len(article_list),
                          'ratio': ratio,
                          'target_ratio': target_ratio,
@@ -290,23 +577,26 @@ class PTCampaignState(object):
                          'progress': ratio / target_ratio,
                          'done': ratio >= target_ratio}
 
+        from glom import glom, T
         ret.campaign_results = glom(gres, {'done_count': (T.values(), ['done_count'], sum),
                                            'not_done_count': (T.values(), ['not_done_count'], sum),
+                                           'unknown_count': (T.values(), ['unknown_count'], sum),
                                            'total_count': (T.values(), ['total_count'], sum)})
-        ret.campaign_results['ratio'] = ret.campaign_results['done_count'] / ret.campaign_results['total_count']
+        known_count = ret.campaign_results['done_count'] + ret.campaign_results['not_done_count']
+        ret.campaign_results['ratio'] = ret.campaign_results['done_count'] / known_count if known_count else 0.0
 
         ret.goal_results = gres
-        ret.article_results = [attr.asdict(a) for a in article_list]
         return ret
 
     def save(self):
         """save to campaign_dir/data/YYYYMM/state_YYMMDD_HHMMSS.json
         and campaign_dir/data/YYYYMM/state_full_YYMMDD_HHMMSS.json"""
-        if not self.goal_results or not self.article_results:
+        if not self.goal_results or not self.article_list:
             raise RuntimeError('only intended to be called after a full results population with from_api()')
         save_timestamp = datetime.datetime.utcnow().isoformat()
 
-        result_path = self.campaign.base_path + self.timestamp.strftime(STATE_PATH_TMPL)
+        result_fn = self.timestamp.strftime(STATE_PATH_TMPL)
+        result_path = self.campaign.base_path + result_fn
         mkdir_p(os.path.split(result_path)[0])
 
         result_data = {'campaign_name': self.campaign.name,
@@ -314,18 +604,25 @@ class PTCampaignState(object):
                        'save_date': save_timestamp,
                        'campaign_results': self.campaign_results,
                        'goal_results': self.goal_results,
-                       'title_list': self.campaign.article_title_list}
+                       'title_list_hash': self.campaign.save_title_list()}
         with atomic_save(result_path) as f:
             json.dump(result_data, f, indent=2, sort_keys=True, default=str)
 
         full_result_fn = self.timestamp.strftime(STATE_FULL_PATH_TMPL)
         full_result_path = self.campaign.base_path + full_result_fn
-        result_data['article_results'] = [attr.asdict(a) for a in self.article_list]
-        with atomic_save(full_result_path) as f:
-            gzf = gzip.GzipFile(filename=full_result_fn, fileobj=f)
-            json.dump(result_data, gzf, default=str)
-            gzf.close()
-
+        # one article at a time, to keep memory flat for big campaigns
+        write_state_file(full_result_path, result_data,
+                         (attr.asdict(pta) for pta in self.article_list),
+                         article_count=len(self.article_list))
+
+        self.campaign.get_state_manifest().add(self.timestamp, result_fn, full_result_fn,
+                                               self.campaign_results, self.goal_results)
+        if self.campaign.history_store:
+            history_rows = ({'title': pta.title,
+                             'rev_id': pta.rev_id,
+                             'talk_rev_id': pta.talk_rev_id,
+                             'results': pta.results} for pta in self.article_list)
+            self.campaign.get_history_store().append(result_data, history_rows)
         return
 
 
@@ -363,14 +660,28 @@ class PTCampaign(object):
     disabled = attr.ib(default=False, repr=False)
     fetch_frequency = attr.ib(default=datetime.timedelta(seconds=3600))
     save_frequency = attr.ib(default=datetime.timedelta(days=1))
+    concurrency = attr.ib(default=DEFAULT_CONCURRENCY)
+    rate_limit = attr.ib(default=DEFAULT_RATE_LIMIT, repr=False)  # max requests per second to each API host
+    request_timeout = attr.ib(default=DEFAULT_TIMEOUT, repr=False)  # seconds, per request attempt
+    article_timeout = attr.ib(default=DEFAULT_ARTICLE_TIMEOUT, repr=False)  # seconds, for all of an article's lookups
+    scan_time_budget = attr.ib(default=None, repr=False)  # timedelta for a whole scan, None for no limit
+    rev_cache_dir = attr.ib(default=None, repr=False)  # defaults to the campaign data dir
+    rev_cache_max_mb = attr.ib(default=512, repr=False)  # 0 to disable the cache
+    article_page_size = attr.ib(default=0, repr=False)  # articles per article list page, 0 for one page
+    article_not_done_shards = attr.ib(default=False, repr=False)  # with pages, also shard each goal's not done articles
+    backend = attr.ib(default=attr.Factory(lambda: parse_backend_config(None)), repr=False)  # see parse_backend_config()
     article_title_list = attr.ib(default=None, repr=False)
     start_state = attr.ib(default=None, repr=False)
     latest_state = attr.ib(default=None, repr=False)  # populate with load_latest_state()
 
     base_path = attr.ib(default=None, repr=False)
+    history_store = attr.ib(default=True, repr=False)  # also save states to the columnar HistoryStore
+    _state_manifest = attr.ib(default=None, repr=False)  # see get_state_manifest()
+    _title_list_hash = attr.ib(default=None, repr=False)  # see save_title_list()
 
     @classmethod
-    def from_path(cls, path, auto_start_state=True):
+    def from_path(cls, path, auto_start_state=True, load_start_state=True):
+        from ruamel import yaml
         config_data = yaml.safe_load(open(path + '/config.yaml', 'rb'))
 
         kwargs = dict(config_data)
@@ -381,13 +692,18 @@ class PTCampaign(object):
             kwargs['save_frequency'] = parse_timedelta(kwargs['save_frequency'])
         if kwargs.get('fetch_frequency'):
             kwargs['fetch_frequency'] = parse_timedelta(kwargs['fetch_frequency'])
+        if kwargs.get('scan_time_budget'):
+            kwargs['scan_time_budget'] = parse_timedelta(kwargs['scan_time_budget'])
+        kwargs['backend'] = parse_backend_config(kwargs.get('backend'))
 
         ret = cls(**kwargs)
+        if not load_start_state:
+            return ret
 
         needs_backfill = False
         with tlog.info('load_start_state') as _act:
             try:
-                start_state = PTCampaignState.from_timestamp(ret, ret.campaign_start_date)
+                start_state = PTCampaignState.from_timestamp(ret, ret.campaign_start_date, full=False)
             except StateNotFound as snf:
                 if not auto_start_state:
                     raise
@@ -425,34 +741,129 @@ class PTCampaign(object):
         alc = self.article_list_config
         if alc['type'] == 'sparql_json_file':
             json_file_path = self.base_path + '/' + alc['path']
-            json_data = json.load(open(json_file_path))
-            title_key = alc['title_key']
-            article_list = [e[title_key] for e in json_data]
-            self.article_title_list = article_list
+            # streamed, see article_list.iter_json_array()
+            self.article_title_list = load_sparql_json_titles(json_file_path, alc['title_key'])
             _act['path'] = json_file_path
-            _act.success('successfully loaded sparql query json at {path}')
+            _act['count'] = len(self.article_title_list)
+            _act.success('successfully loaded {count} titles from sparql query json at {path}')
         elif alc['type'] == 'yaml_file':
             yaml_file_path = self.base_path + '/' + alc['path']
             title_key = alc['title_key']
+            from ruamel import yaml
             article_list = yaml.safe_load(open(yaml_file_path, 'rb')).get(title_key)
-            self.article_title_list = article_list
+            self.article_title_list = list(iter_unique_titles(article_list))
             _act['path'] = yaml_file_path
-            _act.success('successfully loaded yaml at {path}')
+            _act['count'] = len(self.article_title_list)
+            _act.success('successfully loaded {count} titles from yaml at {path}')
         else:
             raise ValueError('expected supported article list type, not %r' % (alc['type'],))
+        self._title_list_hash = None
         return
 
-    def load_all_states(self, full=False):
-        """TODO: probably use a function like this to load in all available
-        data for charting or pace calculation"""
-        pass
+    def save_title_list(self):
+        """Store the article title list in the data directory, once per
+        distinct list, returning its content hash for states to refer
+        to, see article_list.save_title_list()."""
+        if self._title_list_hash is None:
+            self._title_list_hash = save_title_list(self.base_path + '/data/', self.article_title_list)
+        return self._title_list_hash
+
+    @tlog.wrap('info', inject_as='_act')
+    def load_all_states(self, _act):
+        """Load the goal results of every saved state, for charting and
+        pace calculation.
+
+        Only summary state files are read, and the series are cached
+        in data/series_cache.json, so each call only parses the states
+        saved since the last one. Points for pruned states stay in the
+        cache.
+
+        :return: a map of goal key to a list of (timestamp, done_count,
+        ratio) tuples, oldest first
+        """
+        cache_path = self.base_path + '/data/' + SERIES_CACHE_FILENAME
+        cache = {'version': SERIES_CACHE_VERSION, 'last_timestamp': '', 'series': {}}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cached = json.load(f)
+            if cached.get('version') == SERIES_CACHE_VERSION:
+                cache = cached
+
+        new_entries = [e for e in self.get_state_manifest().get_entries(full=False)
+                       if e['timestamp'] > cache['last_timestamp']]
+        for entry in new_entries:
+            state_data = load_state_file(self.base_path + entry['path'])
+            for key, goal_result in state_data['goal_results'].items():
+                point = [unicode(state_data['timestamp']), goal_result['done_count'], goal_result['ratio']]
+                cache['series'].setdefault(key, []).append(point)
+            cache['last_timestamp'] = entry['timestamp']
+        if new_entries:
+            with atomic_save(cache_path) as f:
+                json.dump(cache, f)
+        _act['new_count'] = len(new_entries)
+
+        ret = {}
+        for key, points in cache['series'].items():
+            ret[key] = [(isoparse(ts), done_count, ratio) for ts, done_count, ratio in points]
+        return ret
+
+    def get_pace(self):
+        """Pace and projected completion date for each goal in the
+        latest state, see pace.get_goal_pace(). Results are cached in
+        data/pace_cache.json, and only recomputed when a new state is
+        saved or the campaign end date or goal targets change.
+        """
+        series = self.load_all_states()
+        goal_results = self.latest_state.goal_results
+        cache_key = {'version': PACE_CACHE_VERSION,
+                     'campaign_end_date': self.campaign_end_date.isoformat(),
+                     'goals': dict([(k, [unicode(series[k][-1][0]) if series.get(k) else None,
+                                         v['target_ratio']])
+                                    for k, v in goal_results.items()])}
+        cache_path = self.base_path + '/data/' + PACE_CACHE_FILENAME
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cached = json.load(f)
+            if cached.get('key') == cache_key:
+                return cached['pace']
+
+        from pace import get_goal_pace  # numpy
+        ret = {}
+        with tlog.info('compute_pace', goal_count=len(goal_results)):
+            for key, goal_result in goal_results.items():
+                if not series.get(key):
+                    continue
+                ret[key] = get_goal_pace(series[key], goal_result['target_ratio'],
+                                         self.campaign_end_date)
+        with atomic_save(cache_path) as f:
+            json.dump({'key': cache_key, 'pace': ret}, f)
+        return ret
+
+    def get_scan_time_budget(self):
+        "The scan time budget in seconds, None for no limit."
+        if not self.scan_time_budget:
+            return None
+        return self.scan_time_budget.total_seconds()
+
+    def get_rev_cache(self):
+        if not self.rev_cache_max_mb:
+            return None
+        from cache import RevisionCache, CACHE_FILENAME
+        cache_dir = self.rev_cache_dir or self.base_path + '/data/'
+        cache_path = os.path.join(os.path.expanduser(cache_dir), CACHE_FILENAME)
+        return RevisionCache(cache_path, max_size=int(self.rev_cache_max_mb * 1024 * 1024))
 
     @tlog.wrap('critical', inject_as='_act', verbose=True)
-    def record_state(self, timestamp=None, _act=None):
+    def record_state(self, timestamp=None, incremental=False, _act=None):
+        """Scan and save a new state. With *incremental*, only articles
+        changed since latest_state are refetched, see
+        PTCampaignState.from_api()."""
         if not timestamp:
             timestamp = datetime.datetime.utcnow()
         _act['timestamp'] = timestamp.isoformat()
-        state = PTCampaignState.from_api(self, timestamp)
+        prev_state = self.latest_state if incremental else None
+        _act['incremental'] = prev_state is not None
+        state = PTCampaignState.from_api(self, timestamp, prev_state=prev_state)
         state.save()
 
         return
@@ -466,15 +877,21 @@ class PTCampaign(object):
                 'save_date': 'latest_state.timestamp',
                 'overall_progress': 'latest_state.campaign_results.ratio',
                 'card_image': 'card_image'}
+        from glom import glom
         ret = glom(self, spec)
         return ret
 
-    def render_report(self):
+    def render_report(self, force=False):
+        """Render the campaign's index.html and campaign.json, unless
+        nothing they're rendered from changed since the last render
+        (or *force* is set)."""
         start_state = [{'name': k, 'result': v} for k, v in self.start_state.goal_results.items()]
         start_state.sort(key=lambda g: g['name'])
         latest_state = [{'name': k, 'result': v} for k, v in self.latest_state.goal_results.items()]
         latest_state.sort(key=lambda g: g['name'])
-        combined = [{'start': s[0], 'latest': s[1]} for s in izip_longest(start_state, latest_state)]
+        pace = self.get_pace()
+        combined = [{'start': s[0], 'latest': s[1], 'pace': pace.get(s[1]['name']) if s[1] else None}
+                    for s in izip_longest(start_state, latest_state)]
         # TODO: Also combine goals, so you can show info about targets, etc.
 
         ctx = {'id': self.id,
@@ -491,30 +908,47 @@ class PTCampaign(object):
                'article_count': len(self.article_title_list),
                'start_state_goal': start_state,
                'latest_state_goal': latest_state,
-               'combined_state': combined
+               'combined_state': combined,
+               'pace': pace
         }
         campaign_static_path = STATIC_PATH + 'campaigns/%s/' % self.id
-        mkdir_p(campaign_static_path)
-        report_html = ASHES_ENV.render('campaign.html', ctx)
         report_path = campaign_static_path + 'index.html'
         report_json_path = campaign_static_path + 'campaign.json'
+        render_key = get_render_key('campaign.html', dict([(k, v) for k, v in ctx.items() if k != 'date_updated']))
+        if not force and is_render_current(campaign_static_path, 'report', render_key,
+                                           [report_path, report_json_path]):
+            tlog.info('skip_render', name='report', campaign=self.id).success('{campaign} report unchanged')
+            return
+        mkdir_p(campaign_static_path)
+        report_html = get_ashes_env().render('campaign.html', ctx)
         with atomic_save(report_path) as html_f, atomic_save(report_json_path) as json_f:
             html_f.write(report_html)
             json.dump(ctx, json_f, indent=2, sort_keys=True)
+        mark_rendered(campaign_static_path, 'report', render_key)
         return
 
     def _get_all_results(self):
         ret = self.latest_state.get_results_struct()
         start = self.start_state.get_results_struct()
-        _title_start_map = dict([(r['title'], r) for r in start])
+        # the start state may predate title normalization
+        _title_start_map = dict([(normalize_title(r['title']), r) for r in start])
         for res in ret:
             res['start'] = _title_start_map.get(res['title'])
         return ret
 
-    def render_article_list(self):
-        all_results = self._get_all_results()
-        for goal in self.goals:
-            goal['slug'] = slugify(goal['name'])
+    def render_article_list(self, force=False):
+        """Render the campaign's articles.html and articles.json, unless
+        nothing they're rendered from changed since the last render
+        (or *force* is set).
+
+        Article results are only loaded if rendering. Saved states
+        don't change, so the states' timestamps and summaries stand in
+        for their article results in the render key.
+
+        With article_page_size set, the list is rendered in pages
+        instead, see _render_article_pages().
+        """
+        goals = [dict(goal, slug=slugify(goal['name'])) for goal in self.goals]
         ctx = {'name': self.name,
                'lang': self.lang,
                'description': self.description,
@@ -525,18 +959,121 @@ class PTCampaign(object):
                'date_created': self.date_created.isoformat(),
                'date_updated': datetime.datetime.utcnow().strftime(UPDATED_DT_FORMAT),
                'article_count': len(self.article_title_list),
-               'all_results': all_results,
-               'goals': [{'name': 'Article', 'slug': 'title'}] + sorted(self.goals, key=lambda s: s['name'])}
+               'goals': [{'name': 'Article', 'slug': 'title'}] + sorted(goals, key=lambda s: s['name'])}
         campaign_static_path = STATIC_PATH + 'campaigns/%s/' % self.id
-        article_list_html = ASHES_ENV.render('articles.html', ctx)
         article_list_path = campaign_static_path + 'articles.html'
         article_list_json_path = campaign_static_path + 'articles.json'
-        mkdir_p(os.path.split(article_list_path)[0])
-        with atomic_save(article_list_path) as html_f, atomic_save(article_list_json_path) as json_f:
-            html_f.write(article_list_html.encode('utf-8'))
-            json.dump(ctx, json_f, indent=2, sort_keys=True)
+        key_data = dict([(k, v) for k, v in ctx.items() if k != 'date_updated'])
+        key_data['states'] = [[to_timestamp_key(state.timestamp), state.campaign_results, state.goal_results]
+                              for state in (self.start_state, self.latest_state)]
+        key_data['page_size'] = self.article_page_size
+        key_data['not_done_shards'] = self.article_not_done_shards
+        render_key = get_render_key('articles.html', key_data)
+        if self.article_page_size:
+            output_paths = [article_list_path, campaign_static_path + ARTICLE_INDEX_PATH]
+        else:
+            output_paths = [article_list_path, article_list_json_path]
+        if not force and is_render_current(campaign_static_path, 'article_list', render_key, output_paths):
+            tlog.info('skip_render', name='article_list', campaign=self.id).success(
+                '{campaign} article list unchanged')
+            return
+        all_results = self._get_all_results()
+        mkdir_p(campaign_static_path)
+        if self.article_page_size:
+            written = self._render_article_pages(ctx, all_results)
+        else:
+            ctx['all_results'] = all_results
+            article_list_html = get_ashes_env().render('articles.html', ctx)
+            with atomic_save(article_list_path) as html_f, atomic_save(article_list_json_path) as json_f:
+                html_f.write(article_list_html.encode('utf-8'))
+                json.dump(ctx, json_f, indent=2, sort_keys=True)
+            written = ['articles.html', 'articles.json']
+        _remove_stale_article_pages(campaign_static_path, written)
+        mark_rendered(campaign_static_path, 'article_list', render_key)
         return
 
+    def _render_article_pages(self, ctx, all_results):
+        """Render the article list, sorted by title, as pages of
+        article_page_size articles: articles.html, articles_2.html,
+        etc., each with a JSON shard of its results under articles/.
+        articles/index.json lists the pages with their title ranges
+        and per-goal tallies. With article_not_done_shards, each goal's
+        not done articles are also written out, in shards of the same
+        size.
+
+        Returns the paths written, relative to the campaign's static
+        directory.
+        """
+        campaign_static_path = STATIC_PATH + 'campaigns/%s/' % self.id
+        mkdir_p(campaign_static_path + ARTICLE_PAGES_DIRNAME)
+        page_size = self.article_page_size
+        goal_keys = sorted([slugify(goal['name']) for goal in self.goals])
+        # tally from the state's results, which are keyed by goal slug,
+        # rather than the positional lists in all_results
+        title_goal_results = dict([(ar['title'], ar['results'])
+                                   for ar in self.latest_state.article_results])
+        all_results = sorted(all_results, key=lambda r: r['title'])
+        page_chunks = chunked(all_results, page_size) or [[]]  # always at least articles.html
+        written = [ARTICLE_INDEX_PATH]
+
+        pages = []
+        not_done_map = dict([(key, []) for key in goal_keys])
+        for i, page_results in enumerate(page_chunks):
+            page_num = i + 1
+            tallies = dict([(key, {'done_count': 0, 'not_done_count': 0, 'unknown_count': 0})
+                            for key in goal_keys])
+            for res in page_results:
+                goal_results = title_goal_results.get(res['title'], {})
+                for key in goal_keys:
+                    result = goal_results.get(key, UNKNOWN_RESULT)
+                    if result.get('unknown'):
+                        tallies[key]['unknown_count'] += 1
+                    elif result['done']:
+                        tallies[key]['done_count'] += 1
+                    else:
+                        tallies[key]['not_done_count'] += 1
+                        not_done_map[key].append(res)
+            pages.append({'page': page_num,
+                          'html_path': 'articles.html' if page_num == 1 else ARTICLE_PAGE_HTML_TMPL % page_num,
+                          'json_path': ARTICLE_SHARD_TMPL % page_num,
+                          'first_title': page_results[0]['title'] if page_results else None,
+                          'last_title': page_results[-1]['title'] if page_results else None,
+                          'count': len(page_results),
+                          'goals': tallies})
+
+        for page, page_results in zip(pages, page_chunks):
+            page_ctx = dict(ctx,
+                            all_results=page_results,
+                            page=page['page'],
+                            page_count=len(pages),
+                            pages=[dict(p, current=p['page'] == page['page']) for p in pages])
+            with atomic_save(campaign_static_path + page['html_path']) as f:
+                f.write(get_ashes_env().render('articles.html', page_ctx).encode('utf-8'))
+            with atomic_save(campaign_static_path + page['json_path']) as f:
+                json.dump({'page': page['page'], 'all_results': page_results}, f, indent=2, sort_keys=True)
+            written.extend([page['html_path'], page['json_path']])
+
+        not_done_shards = {}
+        if self.article_not_done_shards:
+            for key in goal_keys:
+                not_done_shards[key] = []
+                for i, shard_results in enumerate(chunked(not_done_map[key], page_size)):
+                    shard_path = ARTICLE_NOT_DONE_SHARD_TMPL % (key, i + 1)
+                    with atomic_save(campaign_static_path + shard_path) as f:
+                        json.dump({'goal': key, 'shard': i + 1, 'all_results': shard_results},
+                                  f, indent=2, sort_keys=True)
+                    not_done_shards[key].append(shard_path)
+                    written.append(shard_path)
+
+        index = dict(ctx, page_size=page_size, page_count=len(pages), pages=pages,
+                     not_done_shards=not_done_shards)
+        with atomic_save(campaign_static_path + ARTICLE_INDEX_PATH) as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        tlog.info('render_article_pages', campaign=self.id, page_count=len(pages),
+                  article_count=len(all_results)).success(
+            'rendered {article_count} articles in {page_count} pages')
+        return written
+
 
     @tlog.wrap('debug')
     def prune_by_frequency(self, dry_run=False):
@@ -544,15 +1081,16 @@ class PTCampaign(object):
         # under data dir, not just the most recent one.
         if not self.save_frequency:
             return
-        if not self.latest_state:
-            self.load_latest_state()
-        state_path = self.get_latest_state_path()
-        if state_path is None:
+        manifest = self.get_state_manifest()
+        latest_entry = manifest.get_latest()
+        if latest_entry is None:
             return
-        target_dir = os.path.dirname(state_path)
+        target_dir = os.path.dirname(latest_entry['full_path'])
 
         for full in (True, False):
-            state_paths = get_state_filepaths(target_dir, full=full)
+            path_key = 'full_path' if full else 'path'
+            state_paths = [e[path_key] for e in manifest.get_entries(full=full)
+                           if os.path.dirname(e[path_key]) == target_dir]
             if not state_paths:
                 return
             tmpl = os.path.basename(STATE_FULL_PATH_TMPL if full else STATE_PATH_TMPL)
@@ -563,85 +1101,171 @@ class PTCampaign(object):
                 if last_kept_dt < (cur_dt - self.save_frequency):
                     last_kept_dt = cur_dt
                 else:
-                    to_prune.append(fsp)
+                    to_prune.append((cur_dt, fsp))
 
-            for p in to_prune:
+            for cur_dt, p in to_prune:
                 with tlog.critical('prune data file', path=p):
                     if dry_run:
                         continue
-                    os.remove(p)
+                    try:
+                        os.remove(self.base_path + p)
+                    except OSError:
+                        if os.path.exists(self.base_path + p):
+                            raise
+                    manifest.remove(cur_dt, full=full)
         return
 
-    def get_latest_state_path(self, full=True):
+    def get_state_manifest(self):
+        """The campaign's StateManifest, rebuilt from the data directory
+        if it does not exist yet."""
+        if self._state_manifest is None:
+            self._state_manifest = StateManifest(self.base_path + '/data/')
+            if not self._state_manifest.exists:
+                self.reindex_states()
+        return self._state_manifest
+
+    @tlog.wrap('critical', inject_as='_act')
+    def reindex_states(self, _act):
+        "Rebuild the state manifest from the state files in the data directory."
         data_base_dir = self.base_path + '/data/'
-        data_dirs = next(os.walk(data_base_dir))[1]
+        _act['path'] = data_base_dir
+        entries = {}
+        data_dirs = next(os.walk(data_base_dir))[1] if os.path.isdir(data_base_dir) else []
         data_dirs = [d for d in data_dirs if d.isdigit()]  # only numeric dir names
-        if not data_dirs:
-            raise StateNotFound('no numeric data directories found in %r' % data_base_dir)
-        latest_dir = data_base_dir + sorted(data_dirs)[-1]
+        for data_dir in sorted(data_dirs):
+            for full in (False, True):
+                tmpl = STATE_FULL_PATH_TMPL if full else STATE_PATH_TMPL
+                for state_path in get_state_filepaths(data_base_dir + data_dir, full=full):
+                    timestamp = datetime.datetime.strptime(os.path.basename(state_path),
+                                                           os.path.basename(tmpl))
+                    entry = entries.get(timestamp)
+                    if entry is None:
+                        # summary numbers are in both summary files and full file headers
+                        state_data = load_state_file(state_path, full=False)
+                        entry = entries[timestamp] = {
+                            'timestamp': to_timestamp_key(timestamp),
+                            'path': None,
+                            'full_path': None,
+                            'campaign_results': state_data.get('campaign_results'),
+                            'goal_results': state_data.get('goal_results')}
+                    entry['full_path' if full else 'path'] = timestamp.strftime(tmpl)
+        if self._state_manifest is None:
+            self._state_manifest = StateManifest(data_base_dir)
+        self._state_manifest.rewrite(entries.values())
+        _act['count'] = len(entries)
+        _act.success('indexed {count} states in {path}')
+        return
+
+    def get_history_store(self):
+        from history import HistoryStore  # numpy
+        return HistoryStore.from_data_dir(self.base_path + '/data/', goals=self.goals)
+
+    @tlog.wrap('critical', inject_as='_act')
+    def rebuild_history(self, _act):
+        "Import every saved full state not yet in the campaign's HistoryStore."
+        history_store = self.get_history_store()
+        imported_count = 0
+        for entry in self.get_state_manifest().get_entries(full=True):
+            imported_count += history_store.import_state_file(self.base_path + entry['full_path'])
+        _act['count'] = imported_count
+        _act.success('imported {count} states into history store')
+        return
 
-        state_paths = get_state_filepaths(latest_dir, full=full)
-        if not state_paths:
+    def get_latest_state_path(self, full=True):
+        entry = self.get_state_manifest().get_latest(full=full)
+        if entry is None:
             return None
 
-        return state_paths[-1]
+        return self.base_path + (entry['full_path'] if full else entry['path'])
 
     def load_latest_state(self):
-        latest_state_path = self.get_latest_state_path(full=True)
-        self.latest_state = PTCampaignState.from_json_path(self, latest_state_path, full=True)
+        # summary only, article_results are loaded if and when needed
+        latest_state_path = self.get_latest_state_path(full=False)
+        self.latest_state = PTCampaignState.from_json_path(self, latest_state_path, full=False)
 
     @tlog.wrap('critical', 'update campaign', verbose=True, inject_as='_act')
-    def update(self, force=False, _act=None):
+    def update(self, force=False, full_scan=False, _act=None):
         "does it all"
         final_update_log_path = STATIC_PATH + 'campaigns/%s/update.log' % self.id
         _act['name'] = self.name
         _act['id'] = self.id
         _act['log_path'] = final_update_log_path
         now = datetime.datetime.utcnow()
+        with self.update_log():
+            self.load_article_list()
+            self.load_latest_state()
+            if not force and not self.is_fetch_due(now):
+                return
+
+            run_stats = RunStats()
+            with run_stats.collecting():
+                self.record_state(incremental=not full_scan)  # defaults to now
+            self.save_run_stats(run_stats)
+            self.finish_update()
+        return
+
+    def save_run_stats(self, run_stats, **extra):
+        """Write the request and lookup stats of the latest update to
+        run_stats.json, next to update.log."""
+        run_stats_path = STATIC_PATH + 'campaigns/%s/run_stats.json' % self.id
+        data = dict(run_stats.to_dict(), campaign_id=self.id,
+                    article_count=len(self.article_title_list or []),
+                    backend=self.backend['type'], **extra)
+        mkdir_p(os.path.dirname(run_stats_path))
+        with atomic_save(run_stats_path) as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        return
+
+    @contextmanager
+    def update_log(self):
+        "Also log to the campaign's update.log, which is published with the report."
+        final_update_log_path = STATIC_PATH + 'campaigns/%s/update.log' % self.id
         with atomic_save(final_update_log_path) as f:
             cur_update_sink = build_stream_sink(f)
             old_sinks = tlog.sinks
             tlog.set_sinks(old_sinks + [cur_update_sink])
             try:
-                self.load_article_list()
-                self.load_latest_state()
-
-                next_fetch = now if not self.latest_state else self.latest_state.timestamp + self.fetch_frequency
-                if not force and next_fetch > now:
-                    tlog.critical('skip_fetch').success(
-                        '{cid} not out of date, skipping until next fetch at {next_fetch}. ',
-                        cid=self.id, next_fetch=next_fetch)
-                    return
-
-                self.record_state()  # defaults to now
-                self.load_latest_state()
-                self.prune_by_frequency()
-                self.render_report()
-                self.render_article_list()
+                yield
             finally:
                 tlog.set_sinks(old_sinks)
         return
 
-    @tlog.wrap('critical', 'render campaign')
-    def render(self):
-        self.load_article_list()
+    def is_fetch_due(self, now):
+        next_fetch = now if not self.latest_state else self.latest_state.timestamp + self.fetch_frequency
+        if next_fetch > now:
+            tlog.critical('skip_fetch').success(
+                '{cid} not out of date, skipping until next fetch at {next_fetch}. ',
+                cid=self.id, next_fetch=next_fetch)
+            return False
+        return True
+
+    def finish_update(self):
+        "After a new state is saved, prune old states and render the reports."
         self.load_latest_state()
+        self.prune_by_frequency()
         self.render_report()
         self.render_article_list()
 
+    @tlog.wrap('critical', 'render campaign')
+    def render(self, force=False):
+        self.load_article_list()
+        self.load_latest_state()
+        self.render_report(force=force)
+        self.render_article_list(force=force)
+
 
 def get_command_str():
     return ' '.join([sys.executable] + [shell_quote(v) for v in sys.argv])
 
 
-def load_and_update_campaign(campaign_dir, force=False):
+def load_and_update_campaign(campaign_dir, force=False, full_scan=False):
     with tlog.critical('load_campaign_dir', path=campaign_dir) as _act:
         ptc = PTCampaign.from_path(campaign_dir)
         _act['name'] = ptc.name
         if ptc.disabled:
             _act.failure("campaign {name!r} disabled, skipping.")
             return ptc
-    ptc.update(force=force)
+    ptc.update(force=force, full_scan=full_scan)
     print()
     print('Goal results:')
     for key, results in ptc.latest_state.goal_results.items():
@@ -650,18 +1274,173 @@ def load_and_update_campaign(campaign_dir, force=False):
     return ptc
 
 
-def get_all_campaign_dirs(abspath=True):
-    # TODO: check for config.yaml in the directory?
-    ret = [CAMPAIGNS_PATH + cd if abspath else cd for cd in os.listdir(CAMPAIGNS_PATH) if not cd.startswith('.')]
-    return sorted(ret)
+@tlog.wrap('critical', inject_as='_act')
+def update_campaigns(campaigns, force=False, full_scan=False, _act=None):
+    """Update several campaigns with a single, shared scan. Articles
+    tracked by more than one campaign are fetched once, at the same
+    timestamp for all campaigns, with the union of the campaigns'
+    fetch plans, and each campaign evaluates its own goals against
+    the shared data.
+
+    Campaigns share a scan per language and backend. The shared scan
+    uses the highest concurrency, timeouts, the lowest rate limit and
+    scan time budget, and the revision cache of the first campaign.
+    """
+    now = datetime.datetime.utcnow()
+    due_campaigns = []
+    for ptc in campaigns:
+        ptc.load_article_list()
+        ptc.load_latest_state()
+        if force or ptc.is_fetch_due(now):
+            due_campaigns.append(ptc)
+    _act['campaign_count'] = len(due_campaigns)
+    _act['article_count'] = 0
+    _act['unique_article_count'] = 0
+
+    scan_groups = bucketize(due_campaigns, lambda ptc: (ptc.lang, json.dumps(ptc.backend, sort_keys=True)))
+    for (lang, _), lang_campaigns in sorted(scan_groups.items()):
+        title_plans = {}
+        prev_article_map = {}
+        for ptc in lang_campaigns:
+            fetch_plan = get_fetch_plan(compile_goals(ptc.goals))
+            for title in ptc.article_title_list:
+                title_plans.setdefault(title, set()).update(fetch_plan)
+            if full_scan or not ptc.latest_state:
+                continue
+            for article_result in ptc.latest_state.article_results:
+                # prefer the previous article with the most attributes fetched
+                title = normalize_title(article_result['title'])
+                prev_article = prev_article_map.get(title)
+                if (prev_article is None or len(article_result.get('fetched', FETCHABLE_ATTRS))
+                        > len(prev_article.get('fetched', FETCHABLE_ATTRS))):
+                    prev_article_map[title] = article_result
+        titles = unique([t for ptc in lang_campaigns for t in ptc.article_title_list])
+        _act['article_count'] += sum([len(ptc.article_title_list) for ptc in lang_campaigns])
+        _act['unique_article_count'] += len(titles)
+
+        time_budgets = [ptc.get_scan_time_budget() for ptc in lang_campaigns if ptc.scan_time_budget]
+        run_stats = RunStats()
+        with run_stats.collecting():
+            article_list = scan_articles(lang, now, [(t, title_plans[t]) for t in titles],
+                                         prev_article_map=prev_article_map,
+                                         concurrency=max([ptc.concurrency for ptc in lang_campaigns]),
+                                         rate_limit=min([ptc.rate_limit for ptc in lang_campaigns]),
+                                         rev_cache=lang_campaigns[0].get_rev_cache(),
+                                         desc='Scanning %s campaigns' % len(lang_campaigns),
+                                         request_timeout=max([ptc.request_timeout for ptc in lang_campaigns]),
+                                         article_timeout=max([ptc.article_timeout for ptc in lang_campaigns]),
+                                         time_budget=min(time_budgets) if time_budgets else None,
+                                         backend=lang_campaigns[0].backend)
+        article_map = dict([(pta.title, pta) for pta in article_list])
+
+        for ptc in lang_campaigns:
+            with ptc.update_log():
+                # copies, as each campaign sets its own goal results
+                ptc_article_list = [attr.evolve(article_map[t]) for t in ptc.article_title_list]
+                state = PTCampaignState.from_articles(ptc, now, ptc_article_list)
+                state.save()
+                # the stats of the whole shared scan
+                ptc.save_run_stats(run_stats, shared_campaign_ids=[c.id for c in lang_campaigns],
+                                   shared_article_count=len(titles))
+                ptc.finish_update()
+    _act.success('updated {campaign_count} campaigns, scanning {unique_article_count}'
+                 ' unique articles of {article_count} tracked')
+    return
 
 
-def render_home(ptcs):
-    ctx = glom(ptcs, {'campaigns': [T.get_summary_ctx()]})
-    index_html = ASHES_ENV.render('index.html', ctx)
+def render_campaign_dir(campaign_dir, force=False):
+    "Load and render one campaign, returning its summary for render_home()."
+    with tlog.critical('load_campaign_dir', path=campaign_dir) as _act:
+        ptc = PTCampaign.from_path(campaign_dir)
+        _act['name'] = ptc.name
+    ptc.render(force=force)
+    return ptc.get_summary_ctx()
+
+
+def _render_campaign_worker(conn, campaign_dir, force):
+    # runs in a render_campaigns() worker process. Logs are buffered
+    # and sent back with the summary, to be written out in campaign
+    # order, rather than interleaved with other workers' in the log file.
+    log_buffer = StringIO()
+    tlog.set_sinks([s for s in tlog.sinks if s is not default_file_sink] + [build_stream_sink(log_buffer)])
+    try:
+        summary, exc_text = render_campaign_dir(campaign_dir, force=force), None
+    except Exception:
+        summary, exc_text = None, traceback.format_exc()
+    conn.send((summary, log_buffer.getvalue(), exc_text))
+    conn.close()
+
+
+def render_campaigns(campaign_dirs, force=False, workers=1):
+    """Load and render each campaign in *campaign_dirs*, returning their
+    summaries, in order. With more than one worker, up to that many
+    campaigns are loaded and rendered at once, each in its own process.
+
+    (multiprocessing.Pool isn't used, as its result handling threads
+    hang if gevent has patched threading, see patch_gevent().)
+    """
+    if workers <= 1 or len(campaign_dirs) <= 1:
+        return [render_campaign_dir(cd, force=force) for cd in campaign_dirs]
+
+    def start_worker(campaign_dir):
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=_render_campaign_worker, args=(send_conn, campaign_dir, force))
+        proc.start()
+        send_conn.close()
+        return campaign_dir, proc, recv_conn
+
+    ret = []
+    to_start, running = list(campaign_dirs), deque()
+    try:
+        while to_start or running:
+            while to_start and len(running) < workers:
+                running.append(start_worker(to_start.pop(0)))
+            campaign_dir, proc, conn = running.popleft()
+            try:
+                summary, log_text, exc_text = conn.recv()
+            except EOFError:  # the worker died without sending
+                summary, log_text, exc_text = None, '', 'worker process exited unexpectedly'
+            proc.join()
+            write_log_text(log_text)
+            if exc_text:
+                raise RuntimeError('failed to render campaign at %s:\n%s' % (campaign_dir, exc_text))
+            ret.append(summary)
+    finally:
+        for _, proc, _ in running:
+            proc.terminate()
+    return ret
+
+
+def _remove_stale_article_pages(campaign_static_path, written):
+    # remove article list pages and shards left over from an earlier
+    # render with more pages, or in another mode
+    stale_paths = []
+    for fn in os.listdir(campaign_static_path):
+        if fn.startswith('articles_') and fn.endswith('.html'):
+            stale_paths.append(fn)
+    if os.path.isdir(campaign_static_path + ARTICLE_PAGES_DIRNAME):
+        stale_paths.extend([ARTICLE_PAGES_DIRNAME + '/' + fn
+                            for fn in os.listdir(campaign_static_path + ARTICLE_PAGES_DIRNAME)])
+    if 'articles.json' not in written:
+        stale_paths.append('articles.json')
+    for path in stale_paths:
+        if path not in written and os.path.exists(campaign_static_path + path):
+            os.remove(campaign_static_path + path)
+    return
+
+
+def render_home(campaign_summaries, force=False):
+    "Render the home page, from the campaigns' get_summary_ctx() summaries."
+    ctx = {'campaigns': campaign_summaries}
     index_path = STATIC_PATH + '/index.html'
+    render_key = get_render_key('index.html', ctx)
+    if not force and is_render_current(STATIC_PATH, 'home', render_key, [index_path]):
+        tlog.info('skip_render', name='home').success('home page unchanged')
+        return
+    index_html = get_ashes_env().render('index.html', ctx)
     with atomic_save(index_path) as f:
         f.write(index_html.encode('utf-8'))
+    mark_rendered(STATIC_PATH, 'home', render_key)
     return
 
 
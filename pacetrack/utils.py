@@ -1 +1,20 @@
 # -*- coding: utf-8 -*-
+"""Project paths and campaign directory helpers.
+
+Kept free of heavy imports, so that commands which only list or
+locate campaigns (e.g., list-campaigns) needn't import pacetrack.update.
+"""
+import os
+
+
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = CUR_PATH + '/templates/'
+PROJECT_PATH = os.path.dirname(CUR_PATH)
+CAMPAIGNS_PATH = PROJECT_PATH + '/campaigns/'
+STATIC_PATH = PROJECT_PATH + '/static/'
+
+
+def get_all_campaign_dirs(abspath=True):
+    # TODO: check for config.yaml in the directory?
+    ret = [CAMPAIGNS_PATH + cd if abspath else cd for cd in os.listdir(CAMPAIGNS_PATH) if not cd.startswith('.')]
+    return sorted(ret)
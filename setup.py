@@ -23,7 +23,7 @@ setup(
     platforms='any',
     version=__version__,
     long_description=__doc__,
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     zip_safe=False,
     entry_points={'console_scripts': ['pt = pacetrack.__main__:main',
@@ -37,11 +37,13 @@ setup(
                       'gevent==1.2.2',
                       'hyperlink',
                       'lithoxyl',
+                      'numpy',
                       'PyNaCl',
                       'requests',
                       'ruamel.yaml',
                       'schema',
-                      'tqdm']
+                      'tqdm'],
+    extras_require={'replica': ['PyMySQL']}  # for the replica DB backend, see pacetrack/dal.py
 )
 
 """